@@ -1,71 +1,90 @@
-import os
 import sys
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
-from astropy.io import fits
 from astropy.coordinates import SkyCoord
 import astropy.units as u
-
-from astropy.coordinates import Angle
-from astropy.table import Table, Column
-from astroquery.skyview import SkyView
-from astroquery.eso import Eso
-eso=Eso()
-import pylab as pl
-import csv
+from astropy.table import Table
 from astropy.io import ascii
 from tabulate import tabulate
-import pdb
-import time
-import pickle
 
-from astroquery.simbad import Simbad
 from astroquery.gaia import Gaia
 from astroquery.vizier import Vizier
 
 Vizier.TIMEOUT = 100000000 # rise the timeout for Vizier
 
-tab=ascii.read('csm_all.txt') # reads the table - no need to specify the format
-# you can print(tab) to check the names of the columns
-ra=tab.field('col1') # read a column into an array
-dec=tab.field('col2')
-c=SkyCoord(ra, dec, unit=(u.hourangle, u.deg)) # makes the array of coordinates with the specific units
-radius=u.Quantity(50, u.arcsec) #sets the radius of the search to 50 arcsecs
-ns=len(c) # checks the number of entries in the table
-# define the table field and their format
-tab_phot = Table(names=('ID', 'ra','dec','plx', 'eplx', 'pmRA', 'e_pmRA', 'pmDE', 'e_pmDE','Gmag','BPmag','RPmag','Kmag','Jmag','Hmag'),dtype=('S20','O','O','O','O','O','O','O','O','O','O','O','O','O','O'))
+col_names=['ID', 'ra','dec','plx', 'eplx', 'pmRA', 'e_pmRA', 'pmDE', 'e_pmDE','Gmag','BPmag','RPmag','Jmag','Hmag','Kmag']
+
+def nearest(target,dist):
+    """
+    given, for each row of a query result, the index of the target it belongs to and its distance from the target,
+    returns the index of the target and the row of the nearest source, for each target with at least one source.
+    """
+    target=np.asarray(target,dtype=int)
+    w=np.lexsort((np.asarray(dist,dtype=float),target))
+    first=np.unique(target[w],return_index=True)[1]
+    return target[w][first],w[first]
+
+def catalogue_search(c,radius=50*u.arcsec,gaia_table='gaiaedr3.gaia_source',chunk_size=10000,gaia=None,vizier=None):
+    """
+    searches Gaia (through a TAP query) and 2MASS (through Vizier) around a list of targets and returns, for each target,
+    astrometry and photometry of the nearest source found in each catalogue.
+    Targets are sent in batches of chunk_size: a single table upload joined with the Gaia catalogue and
+    a single multi-target Vizier query per batch.
+
+    input:
+        c: a SkyCoord array with the coordinates of the targets
+        radius (optional): search radius. Default: 50 arcsec
+        gaia_table (optional): Gaia table to be searched. Default: 'gaiaedr3.gaia_source'
+        chunk_size (optional): maximum number of targets per query. Default: 10000
+        gaia, vizier (optional): objects used to query the services, with the same interface as
+            astroquery.gaia.Gaia and astroquery.vizier.Vizier (e.g. local stand-ins). Default: None (=astroquery)
+
+    usage:
+        tab=catalogue_search(SkyCoord(ra, dec, unit=(u.hourangle, u.deg)))
+        returns a Table with the columns of col_names and one row per target, in the same order (ra and dec in deg).
+
+    notes:
+    values are set to 0 if no source is found within radius, to NaN if the source has no value.
+    """
+    if type(gaia)==type(None): gaia=Gaia
+    if type(vizier)==type(None): vizier=Vizier(columns=['Jmag','Hmag','Kmag','+_r'],row_limit=-1) # '+_r': sorted by distance, no row limit
+    ns=len(c)
+    r=radius.to(u.deg).value
+    val={k:np.zeros(ns) for k in col_names[3:]} # results are stored column-wise, 0 if no source is found
+    gaia_cols=[['plx','parallax'],['eplx','parallax_error'],['pmRA','pmra'],['e_pmRA','pmra_error'],['pmDE','pmdec'],['e_pmDE','pmdec_error'],
+               ['Gmag','phot_g_mean_mag'],['BPmag','phot_bp_mean_mag'],['RPmag','phot_rp_mean_mag']]
+    query=("SELECT t.target_id, DISTANCE(POINT('ICRS',g.ra,g.dec),POINT('ICRS',t.ra,t.dec)) AS dist, "+
+           ', '.join(['g.'+x[1] for x in gaia_cols])+" FROM "+gaia_table+" AS g JOIN TAP_UPLOAD.targets AS t "+
+           "ON 1=CONTAINS(POINT('ICRS',g.ra,g.dec),CIRCLE('ICRS',t.ra,t.dec,"+'{0:.10f}'.format(float(r))+"))")
+    for start in range(0,ns,chunk_size):
+        cc=c[start:start+chunk_size]
+        # search EDR3: the whole batch is uploaded and joined with the catalogue
+        targets=Table([np.arange(start,start+len(cc)),cc.ra.deg,cc.dec.deg],names=('target_id','ra','dec'))
+        g2=gaia.launch_job_async(query,upload_resource=targets,upload_table_name='targets').get_results()
+        if len(g2)>0:
+            i,k=nearest(g2['target_id'],g2['dist'])
+            for name,col in gaia_cols: val[name][i]=np.ma.filled(np.ma.asarray(g2[col][k],dtype=float),fill_value=np.nan)
+        # search 2MASS: one query for all the targets of the batch; '_q' is the (1-based) index of the target
+        d=vizier.query_region(cc, radius=radius, catalog="II/246")
+        if len(d)>0 and len(d[0])>0:
+            q=np.array(d[0]['_q'],dtype=int)-1+start if '_q' in d[0].colnames else np.full(len(d[0]),start)
+            i,k=nearest(q,d[0]['_r'] if '_r' in d[0].colnames else np.zeros(len(q)))
+            for name in ['Jmag','Hmag','Kmag']: val[name][i]=np.ma.filled(np.ma.asarray(d[0][name][k],dtype=float),fill_value=np.nan)
 
-for i in range (ns): #loops over the first 100 elements
-                     # note that range(n) generates n integers between 0 and n-1
-    #remember to ALWAYS indent the loops.
-    #set variables to 0 to have an entry in the table even if no source is found in Gaia or 2MASS
-    plx=eplx=pmra=empra=pmdec=epmdec=Gmag=BPmag=RPmag=Jmag=Kmag=Hmag=0.0
-    # search EDR3
-    g2=Gaia.cone_search_async(c[i], radius, table_name='gaiaedr3.gaia_source').get_results()
-    if g2: # only if there is an entry in gaia takes the values of the first entry
-        plx = g2['parallax'][0]
-        eplx = g2['parallax_error'][0]
-        pmra = g2['pmra'][0]
-        epmra = g2['pmra_error'][0]
-        pmdec = g2['pmdec'][0]
-        epmdec = g2['pmdec_error'][0]
-        Gmag = g2['phot_g_mean_mag'][0]
-        BPmag = g2['phot_bp_mean_mag'][0]
-        RPmag = g2['phot_rp_mean_mag'][0]
-    # search 2MASS
-    d=Vizier.query_region(c[i], radius, catalog="II/246")
-    if d: # only if there is an entry in "2MASS" takes the values of the first entry
-          # note that since you've used Vizier the format of the output is different
-        Jmag=d[0][0]['Jmag']
-        Hmag=d[0][0]['Hmag']
-        Kmag=d[0][0]['Kmag']
-    #add a row to the table
-    ID='Star #'+np.str(i)
-    tab_phot.add_row((ID, ra[i], dec[i], plx, eplx, pmra, epmra, pmdec, epmdec, Gmag, BPmag, RPmag, Jmag, Hmag, Kmag))
-    print(ID, ra[i], dec[i], plx, eplx, pmra, epmra, pmdec, epmdec, Gmag, BPmag, RPmag, Jmag, Hmag, Kmag)
-# write the table in a comma separated file (can also be a tab separated file if format = 'tab')
+    tab_phot=Table([np.array(['Star #'+str(i) for i in range(ns)]),c.ra.deg,c.dec.deg]+
+                   [val[k] for k in col_names[3:]],names=col_names)
+    return tab_phot
 
-f=open('csm_tab.txt', "w+")
-f.write(tabulate(tab_phot,headers=['ID', 'ra','dec','plx', 'eplx', 'pmRA', 'e_pmRA', 'pmDE', 'e_pmDE','Gmag','BPmag','RPmag','Kmag','Jmag','Hmag'], tablefmt='tsv'))
-f.close()
+if __name__=='__main__':
+    file_in=sys.argv[1] if len(sys.argv)>1 else 'csm_all.txt'
+    file_out=sys.argv[2] if len(sys.argv)>2 else 'csm_tab.txt'
+    tab=ascii.read(file_in) # reads the table - no need to specify the format
+    ra=tab.field('col1') # read a column into an array
+    dec=tab.field('col2')
+    c=SkyCoord(ra, dec, unit=(u.hourangle, u.deg)) # makes the array of coordinates with the specific units
+    tab_phot=catalogue_search(c,radius=u.Quantity(50, u.arcsec)) #sets the radius of the search to 50 arcsecs
+    tab_phot['ra']=ra
+    tab_phot['dec']=dec
+    # write the table in a tab separated file
+    f=open(file_out, "w+")
+    f.write(tabulate(tab_phot,headers=col_names, tablefmt='tsv'))
+    f.close()
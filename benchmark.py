@@ -0,0 +1,115 @@
+# coding: utf-8
+
+#benchmarks for the age-fitting routines of pelux_core.
+#usage: python benchmark.py [n_stars]
+#the stars are drawn from a synthetic grid (synthetic_grid, synthetic_sample), not from the shipped all_cms.txt,
+#which only lists coordinates: its photometry would require search_phot and network access.
+#mag_window is in units of the photometric error of each star (mag_window*phot_err), as in isochronal_age.
+#times are measured on n stars; memory is traced on n and 4n stars, to separate the fixed cost from the cost per star.
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+from pelux_core import *
+from pelux_core import _fit_workspace
+
+
+def synthetic_grid(n_steps=[1000,500]):
+    """
+    builds a synthetic isochrone grid with the same structure as the output of load_isochrones
+    (masses, ages, filters, grid), to be used when no model file is available.
+    Magnitudes depend smoothly on mass and age; massive stars at old ages are set to NaN.
+    """
+    mnew=np.linspace(0.01,1.4,n_steps[0])
+    anew=np.exp(np.linspace(0,np.log(1000),n_steps[1]))
+    fnew=np.array(['G','Gbp','Grp','J','H','K','W1','W2','W3','W4'])
+    lm=np.log10(mnew)[:,None]
+    la=np.log10(anew)[None,:]
+    base=6.5-7.5*lm+0.9*la+0.3*lm*la
+    col=[0,0.6,-0.7,-1.8,-2.3,-2.5,-2.6,-2.7,-2.8,-2.9]
+    grid=np.empty([len(mnew),len(anew),len(fnew)])
+    for k in range(len(fnew)): grid[:,:,k]=base+col[k]*(1.2-0.5*lm)
+    grid[(lm>-0.05) & (la>2.7),:]=np.nan
+    return mnew,anew,fnew,grid
+
+def synthetic_sample(iso,n=100,seed=0):
+    """
+    draws n stars from the grid iso and returns them in the same format as search_phot:
+    phot, phot_err, filters, parallax, parallax error, flags.
+    """
+    rng=np.random.default_rng(seed)
+    mnew,anew,fnew,grid=iso
+    filters=np.array(['G','Gbp','Grp','G2','Gbp2','Grp2','J','H','K','W1','W2','W3','W4'])
+    im=rng.integers(5,int(0.9*len(mnew)),n)
+    ia=rng.integers(0,int(0.9*len(anew)),n)
+    par=rng.uniform(5,30,n)
+    dm=5*np.log10(100./par)
+    phot=np.full([n,len(filters)],np.nan)
+    phot_err=rng.uniform(0.01,0.05,[n,len(filters)])
+    for j in range(len(filters)):
+        f=filters[j][:-1] if filters[j] in ['G2','Gbp2','Grp2'] else filters[j]
+        k,=np.where(fnew==f)
+        phot[:,j]=grid[im,ia,k[0]]+dm+rng.normal(0,0.03,n)
+    flags={'2MASS':{'qfl':np.full(n,'AAA')},'ALLWISE':{'ccf':np.full(n,'0000')},
+           'GAIA_EDR3':{'edr3_bp_rp_excess_factor_corr':rng.normal(0,0.01,n)},
+           'GAIA_DR2':{'dr2_bp_rp_excess_factor_corr':rng.normal(0,0.01,n)}}
+    return phot,phot_err,filters,par,0.02*par,flags
+
+def subsample(sample,k):
+    """the first k stars of a sample returned by synthetic_sample"""
+    phot,phot_err,filters,par,par_err,flags=sample
+    return phot[:k],phot_err[:k],filters,par[:k],par_err[:k],{s:{q:flags[s][q][:k] for q in flags[s]} for s in flags}
+
+def bench_time(iso,sample,**kwargs):
+    """
+    fits the sample with isochronal_age and returns the elapsed time per star and the output.
+    A first fit of one star fills the grid cache (and compiles the numba kernel) before timing.
+    """
+    isochronal_age(*subsample(sample,1),iso,None,**kwargs) #warm-up
+    t0=time.perf_counter()
+    res=isochronal_age(*sample,iso,None,**kwargs)
+    t1=time.perf_counter()
+    return (t1-t0)/len(sample[0]),res
+
+def bench_memory(iso,sample,n,**kwargs):
+    """
+    fits the first n and the first 4n stars of the sample with isochronal_age under tracemalloc, and returns:
+    the peak traced memory with n stars, the size of the fitting workspace (allocated once per call),
+    the memory per star, from the difference of the two peaks, and the fixed memory, i.e. the peak with n stars
+    minus n times the memory per star. Times are measured separately by bench_time: tracemalloc slows down
+    every allocation.
+    """
+    isochronal_age(*subsample(sample,1),iso,None,**kwargs) #warm-up: fills the grid cache
+    if kwargs.get('kernel')=='numba': ws=_fit_workspace(iso[3].shape[:2],0,0) #come in isochronal_age
+    else: ws=_fit_workspace(iso[3].shape[:2],6,4)
+    ws_bytes=sum([ws[k].nbytes for k in ws])
+    del ws
+    peak=[]
+    for k in [n,4*n]:
+        tracemalloc.start()
+        isochronal_age(*subsample(sample,k),iso,None,**kwargs)
+        peak.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    per_star=(peak[1]-peak[0])/(3*n)
+    return {'peak_MB':peak[0]/2**20,'workspace_MB':ws_bytes/2**20,'per_star_kB':per_star/2**10,
+            'fixed_MB':(peak[0]-n*per_star)/2**20}
+
+if __name__=='__main__':
+    n=int(sys.argv[1]) if len(sys.argv)>1 else 50
+    iso=synthetic_grid()
+    sample=synthetic_sample(iso,n=4*n) #n stars for the times, n and 4n for the memory
+    grid_MB=iso[3][:,:,0].nbytes/2**20
+    print('grid: {0}x{1}, {2:.1f} MB per filter'.format(len(iso[0]),len(iso[1]),grid_MB))
+    modes=[('full',{}),('mag_window=5*err',{'mag_window':5}),('pyramid',{'search':'pyramid'}),
+           ('raster',{'search':'raster'}),('numba',{'kernel':'numba'})]
+    for name,kwargs in modes:
+        kwargs.setdefault('kernel','numpy')
+        try: t,res=bench_time(iso,subsample(sample,n),**kwargs)
+        except ValueError:
+            print('{0:16s} not available'.format(name))
+            continue
+        if name=='full': ref=res
+        same=all([np.array_equal(x,y,equal_nan=True) for x,y in zip(res,ref)])
+        r=bench_memory(iso,sample,n,**kwargs)
+        print('{0:16s} {1:8.2f} ms/star   identical to full: {2:5s}   peak {3:7.1f} MB   workspace {4:7.1f} MB   fixed {5:7.1f} MB   per star {6:6.2f} kB'.format(name,1000*t,str(same),r['peak_MB'],r['workspace_MB'],r['fixed_MB'],r['per_star_kB']))
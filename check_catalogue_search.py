@@ -0,0 +1,88 @@
+# coding: utf-8
+
+#checks catalogue_search (CatalogueSearch.py) against stand-ins of the Gaia TAP service and of Vizier.
+#usage: python check_catalogue_search.py [n_targets]
+#the stand-ins record the ADQL query and match the uploaded targets with a synthetic source list by brute force:
+#the query must be valid ADQL (plain decimal radius), and the results must not depend on chunk_size.
+#no network access is needed.
+
+import sys
+import numpy as np
+from astropy.coordinates import SkyCoord
+import astropy.units as u
+from astropy.table import Table
+from CatalogueSearch import catalogue_search, col_names
+
+
+class StandInJob:
+    def __init__(self,results):
+        self.results=results
+
+    def get_results(self):
+        return self.results
+
+class StandInGaia:
+    """same interface as astroquery.gaia.Gaia.launch_job_async, on a Table of synthetic sources"""
+    def __init__(self,sources,radius):
+        self.sources=sources
+        self.radius=radius
+        self.queries=[]
+
+    def launch_job_async(self,query,upload_resource=None,upload_table_name=None):
+        self.queries.append(query)
+        t=upload_resource
+        c1=SkyCoord(ra=np.array(t['ra'])*u.deg,dec=np.array(t['dec'])*u.deg)
+        c2=SkyCoord(ra=np.array(self.sources['ra'])*u.deg,dec=np.array(self.sources['dec'])*u.deg)
+        i1,i2,d,_=c2.search_around_sky(c1,self.radius)
+        res=Table([np.array(t['target_id'])[i1],d.deg],names=('target_id','dist'))
+        for col in self.sources.colnames:
+            if col not in ['ra','dec']: res[col]=self.sources[col][i2]
+        return StandInJob(res)
+
+class StandInVizier:
+    """same interface as astroquery.vizier.Vizier.query_region, on a Table of synthetic 2MASS sources"""
+    def __init__(self,sources):
+        self.sources=sources
+
+    def query_region(self,c,radius,catalog):
+        c2=SkyCoord(ra=np.array(self.sources['ra'])*u.deg,dec=np.array(self.sources['dec'])*u.deg)
+        i1,i2,d,_=c2.search_around_sky(c,radius)
+        res=Table([i1+1,d.arcsec],names=('_q','_r')) # '_q': 1-based index of the target
+        for col in ['Jmag','Hmag','Kmag']: res[col]=self.sources[col][i2]
+        return [res]
+
+def synthetic_sources(c,n_per_target=3,seed=0):
+    """a few sources within about 30 arcsec of each target of the SkyCoord array c, with random values"""
+    rng=np.random.default_rng(seed)
+    n=len(c)*n_per_target
+    src=np.repeat(np.arange(len(c)),n_per_target)
+    off=rng.normal(0,15/3600,[n,2])
+    gaia=Table([np.mod(c.ra.deg[src]+off[:,0],360),np.clip(c.dec.deg[src]+off[:,1],-90,90)],names=('ra','dec'))
+    for col in ['parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','phot_g_mean_mag','phot_bp_mean_mag','phot_rp_mean_mag']:
+        gaia[col]=rng.uniform(1,15,n)
+    off=rng.normal(0,15/3600,[n,2])
+    tmass=Table([np.mod(c.ra.deg[src]+off[:,0],360),np.clip(c.dec.deg[src]+off[:,1],-90,90)],names=('ra','dec'))
+    for col in ['Jmag','Hmag','Kmag']: tmass[col]=rng.uniform(5,15,n)
+    return gaia,tmass
+
+if __name__=='__main__':
+    n=int(sys.argv[1]) if len(sys.argv)>1 else 20
+    rng=np.random.default_rng(1)
+    c=SkyCoord(ra=rng.uniform(0,360,n)*u.deg,dec=rng.uniform(-80,80,n)*u.deg)
+    radius=50*u.arcsec
+    gaia_src,tmass_src=synthetic_sources(c)
+    expected=("SELECT t.target_id, DISTANCE(POINT('ICRS',g.ra,g.dec),POINT('ICRS',t.ra,t.dec)) AS dist, "+
+              "g.parallax, g.parallax_error, g.pmra, g.pmra_error, g.pmdec, g.pmdec_error, "+
+              "g.phot_g_mean_mag, g.phot_bp_mean_mag, g.phot_rp_mean_mag FROM gaiaedr3.gaia_source AS g "+
+              "JOIN TAP_UPLOAD.targets AS t ON 1=CONTAINS(POINT('ICRS',g.ra,g.dec),CIRCLE('ICRS',t.ra,t.dec,0.0138888889))")
+    checks=[]
+    res=[]
+    for chunk_size in [n,7]:
+        gaia=StandInGaia(gaia_src,radius)
+        res.append(catalogue_search(c,radius=radius,chunk_size=chunk_size,gaia=gaia,vizier=StandInVizier(tmass_src)))
+        checks.append(len(gaia.queries)==-(-n//chunk_size) and all([q==expected for q in gaia.queries]))
+        print('chunk_size={0:3d}   queries: {1:2d}   ADQL as expected: {2}'.format(chunk_size,len(gaia.queries),checks[-1]))
+    same=all([np.array_equal(res[0][k],res[1][k]) for k in col_names])
+    found=np.sum(res[0]['Gmag']!=0)==n and np.sum(res[0]['Jmag']!=0)==n
+    print('targets: {0}, with Gaia and 2MASS sources: {1}, results independent of chunk_size: {2}'.format(n,found,same))
+    sys.exit(0 if all(checks) and same and found else 1)
@@ -0,0 +1,164 @@
+# coding: utf-8
+
+#checks the local cross-match of search_phot (keyword catalogue_path) against a mocked XMatch run.
+#usage: python check_catalogues.py [n_stars]
+#a synthetic extract of every survey, with the columns requested to XMatch, is matched by a stand-in of XMatch.query
+#and, after being split in HEALPix tiles by write_tiles, by local_xmatch: search_phot must return the same results.
+#the mocked run is repeated with a stand-in that fails on the first attempts of every chunk: search_phot must retry
+#each chunk the expected number of times, and reassemble the same results, also when the chunks are queried
+#concurrently and complete out of order.
+#requires astropy_healpix (write_tiles); no network access is needed.
+
+import sys
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from astropy.table import Table, MaskedColumn
+import pelux_core
+from pelux_core import *
+from pelux_core import _survey_radec, _survey_properties, _query_cols
+
+
+def synthetic_catalogues(coo,surveys,n_rows=300,seed=0):
+    """
+    builds, for every survey, a synthetic extract of the catalogue with the same columns returned by XMatch
+    (those listed in search_phot, plus the J2000 position columns), to be used as a tile fixture.
+    Sources are scattered within about 1 arcsec of random stars of coo (a (no. of stars, 2) array of ra, dec in deg),
+    so that stars can have no, one or several counterparts; 10% of the numerical values are masked.
+    """
+    rng=np.random.default_rng(seed)
+    cats={}
+    for survey in surveys:
+        src=rng.integers(0,len(coo),n_rows)
+        off=rng.normal(0,0.6/3600,[n_rows,2])
+        ra_name,dec_name=_survey_radec(survey)
+        t=Table()
+        for col in _query_cols(survey):
+            if col in ['2MASS','AllWISE','JNAME']: t[col]=np.array(['S%05d' % k for k in range(n_rows)])
+            elif col=='Qfl': t[col]=rng.choice(['AAA','ABA','UUU'],n_rows)
+            elif col in ['ccf','cc_flags']: t[col]=rng.choice(['0000','00h0'],n_rows)
+            elif col=='source_id': t[col]=np.arange(n_rows,dtype=np.int64)
+            else: t[col]=MaskedColumn(rng.uniform(5,15,n_rows),mask=rng.random(n_rows)<0.1)
+        t[dec_name]=np.clip(coo[src,1]+off[:,1],-90,90)
+        t[ra_name]=np.mod(coo[src,0]+off[:,0]/np.cos(np.radians(coo[src,1])),360)
+        cats[survey]=t
+    return cats
+
+def mock_xmatch(cats):
+    """
+    returns a function with the same interface as XMatch.query, which matches the input table
+    against the tables of synthetic_catalogues by brute force.
+    """
+    codes={_survey_properties(survey)[0]:survey for survey in cats}
+
+    def query(cat1,cat2,max_distance,colRA1,colDec1,cols2=None,**kwargs):
+        survey=codes[cat2]
+        t=cats[survey]
+        ra_name,dec_name=_survey_radec(survey)
+        c1=SkyCoord(ra=np.array(cat1[colRA1],dtype=float)*u.deg,dec=np.array(cat1[colDec1],dtype=float)*u.deg)
+        c2=SkyCoord(ra=np.array(t[ra_name])*u.deg,dec=np.array(t[dec_name])*u.deg)
+        i1,i2,d=[],[],[]
+        for i in range(len(c1)):
+            sep=c1[i].separation(c2).arcsec
+            w,=np.where(sep<max_distance.to(u.arcsec).value)
+            i1.extend([i]*len(w))
+            i2.extend(w)
+            d.extend(sep[w])
+        i1=np.array(i1,dtype=int)
+        i2=np.array(i2,dtype=int)
+        res=Table()
+        res['angDist']=np.array(d,dtype=float)
+        for col in cat1.colnames: res[col]=cat1[col][i1]
+        cols=t.colnames if type(cols2)==type(None) else cols2.split(',')
+        for col in cols:
+            if col not in cat1.colnames: res[col]=t[col][i2]
+        return res
+
+    return query
+
+def flaky_xmatch(query,fails=0,delay=None):
+    """
+    wraps a function with the interface of XMatch.query (e.g. the output of mock_xmatch). Every chunk, identified by
+    the catalogue and the coordinates of its first star, raises ConnectionError on its first "fails" calls;
+    if given, delay(ra,dec) is the time [s] waited before every answer.
+    Returns the wrapper and the list of calls, as (catalogue, ra, dec, 'failed' or 'ok') in order of completion.
+    """
+    log=[]
+    lock=threading.Lock()
+
+    def flaky(cat1,cat2,**kwargs):
+        chunk=(cat2,float(cat1['RA'][0]),float(cat1['DEC'][0]))
+        if type(delay)!=type(None): time.sleep(delay(chunk[1],chunk[2]))
+        with lock: n_calls=len([x for x in log if x[:3]==chunk])
+        if n_calls<fails:
+            with lock: log.append(chunk+('failed',))
+            raise ConnectionError('simulated failure of '+cat2)
+        res=query(cat1,cat2,**kwargs)
+        with lock: log.append(chunk+('ok',))
+        return res
+
+    return flaky,log
+
+def same_results(r1,r2):
+    """True if two outputs of search_phot (coordinates, photometry, errors, flags, headers) are identical"""
+    same=all([np.array_equal(r1[k],r2[k],equal_nan=True) for k in range(3)])
+    for survey in r1[3]:
+        for q in r1[3][survey]: same=same and np.array_equal(np.asarray(r1[3][survey][q]).astype(str),np.asarray(r2[3][survey][q]).astype(str))
+    return same and [list(h) for h in r1[4]]==[list(h) for h in r2[4]]
+
+if __name__=='__main__':
+    n=int(sys.argv[1]) if len(sys.argv)>1 else 40
+    surveys=['2MASS','ALLWISE','WISE'] #GAIA_EDR3 e GAIA_DR2 sono sempre aggiunte da search_phot
+    rng=np.random.default_rng(1)
+    coo=np.column_stack((rng.uniform(0,360,n),rng.uniform(-80,80,n)))
+    coo[0]=[0.0001,89.9999] #polo e RA=0
+    coo[1]=[359.9999,0.]
+    cats=synthetic_catalogues(coo,['GAIA_EDR3','GAIA_DR2']+surveys)
+    chunk_size=10
+    n_chunks=5*(-(-n//chunk_size)) #5 survey, comprese GAIA_EDR3 e GAIA_DR2
+    checks=[]
+    with tempfile.TemporaryDirectory() as d:
+        file=os.path.join(d,'sample.txt')
+        np.savetxt(file,coo)
+        pelux_core.XMatch.query=mock_xmatch(cats)
+        try: r1=search_phot(file,surveys,overwrite=True,query_cache=os.path.join(d,'cache_xmatch'))
+        finally: del pelux_core.XMatch.query
+        for survey in cats: write_tiles(cats[survey],os.path.join(d,'catalogues'),survey)
+        r2=search_phot(file,surveys,overwrite=True,query_cache=os.path.join(d,'cache_local'),catalogue_path=os.path.join(d,'catalogues'))
+        checks.append(same_results(r1,r2))
+        print('stars: {0}, matched photometric values: {1}, local cross-match identical to XMatch: {2}'.format(n,np.sum(np.isfinite(r1[1])),checks[-1]))
+
+        #ogni chunk fallisce due volte: con max_retries=3 la terza chiamata riesce, dopo attese di retry_wait e 2*retry_wait
+        pelux_core.XMatch.query,log=flaky_xmatch(mock_xmatch(cats),fails=2)
+        t0=time.perf_counter()
+        try: r3=search_phot(file,surveys,overwrite=True,query_cache=os.path.join(d,'cache_retry'),chunk_size=chunk_size,n_jobs=1,max_retries=3,retry_wait=0.01)
+        finally: del pelux_core.XMatch.query
+        t1=time.perf_counter()
+        n_ok=len([x for x in log if x[3]=='ok'])
+        checks.append(len(log)==3*n_chunks and n_ok==n_chunks and t1-t0>=n_chunks*0.03 and same_results(r1,r3))
+        print('chunks: {0}, calls: {1} ({2} failed), {3:.2f} s, identical to the run without failures: {4}'.format(n_chunks,len(log),len(log)-n_ok,t1-t0,checks[-1]))
+
+        #ogni chunk fallisce più di max_retries volte: ogni chunk tentato riceve max_retries+1 chiamate, poi search_phot si ferma
+        #(i chunk non ancora avviati sono annullati)
+        pelux_core.XMatch.query,log=flaky_xmatch(mock_xmatch(cats),fails=5)
+        try: search_phot(file,surveys,overwrite=True,query_cache=os.path.join(d,'cache_fail'),chunk_size=chunk_size,n_jobs=1,max_retries=2,retry_wait=0.01)
+        except ConnectionError: raised=True
+        else: raised=False
+        finally: del pelux_core.XMatch.query
+        tried=set([x[:3] for x in log])
+        per_chunk=[len([x for x in log if x[:3]==c]) for c in tried]
+        checks.append(raised and len(tried)>0 and per_chunk==[3]*len(tried))
+        print('max_retries=2: error raised: {0}, chunks tried: {1}, calls per chunk: {2}'.format(raised,len(tried),sorted(set(per_chunk))))
+
+        #chunk interrogati in parallelo: il primo chunk di ogni survey è il più lento e fallisce una volta, come tutti gli altri
+        first=lambda ra,dec: np.isclose(ra,coo[0,0]) and np.isclose(dec,coo[0,1])
+        pelux_core.XMatch.query,log=flaky_xmatch(mock_xmatch(cats),fails=1,delay=lambda ra,dec: 0.2 if first(ra,dec) else 0.01)
+        try: r4=search_phot(file,surveys,overwrite=True,query_cache=os.path.join(d,'cache_threads'),chunk_size=chunk_size,n_jobs=4,max_retries=1,retry_wait=0.01)
+        finally: del pelux_core.XMatch.query
+        ok=[x for x in log if x[3]=='ok']
+        out_of_order=first(*ok[0][1:3])==False #un chunk successivo è stato completato prima del primo
+        checks.append(len(log)==2*n_chunks and len(ok)==n_chunks and out_of_order and same_results(r1,r4))
+        print('n_jobs=4: calls: {0} ({1} failed), completed out of order: {2}, identical to the run without failures: {3}'.format(len(log),len(log)-len(ok),out_of_order,same_results(r1,r4)))
+    sys.exit(0 if all(checks) else 1)
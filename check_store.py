@@ -0,0 +1,43 @@
+# coding: utf-8
+
+#checks the memoized isochronal_age (keyword store) against direct fits of the same sample.
+#usage: python check_store.py [n_stars]
+#the sample is fitted with store while quality_mask and preprocessed change between calls: the results read from
+#the store must always be identical to those of a direct fit with the same inputs.
+#the stars are drawn from the synthetic grid of benchmark.py; no model file or network access is needed.
+
+import sys
+import os
+import tempfile
+import numpy as np
+from pelux_core import *
+from benchmark import synthetic_grid, synthetic_sample
+
+
+def same_fit(r1,r2):
+    """True if two outputs of isochronal_age are identical"""
+    return len(r1)==len(r2) and all([np.array_equal(x,y,equal_nan=True) for x,y in zip(r1,r2)])
+
+if __name__=='__main__':
+    n=int(sys.argv[1]) if len(sys.argv)>1 else 10
+    iso=synthetic_grid([200,100])
+    phot,phot_err,filters,par,par_err,flags=synthetic_sample(iso,n=n)
+    good=phot_quality_mask(phot,filters,flags,par=par)
+    bad=np.zeros_like(good) #nessuna magnitudine utilizzabile: nessun fit
+    part=good.copy()
+    part[0,np.where(filters=='K')[0]]=False #una sola stella cambia
+    prep=preprocess_phot(phot,phot_err,filters,par,par_err,flags)
+    prep2={k:(v.copy() if type(v)==np.ndarray else v) for k,v in prep.items()}
+    prep2['phot'][1]+=0.2
+
+    checks=[]
+    with tempfile.TemporaryDirectory() as d:
+        store=os.path.join(d,'store.pkl')
+        for name,kw in [('quality_mask: all True',{'quality_mask':good}),('quality_mask: all False',{'quality_mask':bad}),
+                        ('quality_mask: one star changed',{'quality_mask':part}),('quality_mask: all True again',{'quality_mask':good}),
+                        ('preprocessed',{'preprocessed':prep}),('preprocessed: one star changed',{'preprocessed':prep2})]:
+            r1=isochronal_age(phot,phot_err,filters,par,par_err,flags,iso,None,**kw)
+            r2=isochronal_age(phot,phot_err,filters,par,par_err,flags,iso,None,store=store,**kw)
+            checks.append(same_fit(r1,r2))
+            print('{0:32s} fitted stars: {1:3d}   store identical to direct fit: {2}'.format(name,np.sum(np.isfinite(r1[0])),checks[-1]))
+    sys.exit(0 if all(checks) else 1)
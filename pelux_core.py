@@ -9,7 +9,10 @@ from scipy.interpolate import interp1d
 from astropy.constants import M_jup,M_sun
 import time
 import pickle
-from astropy.coordinates import Angle, SkyCoord, Galactocentric
+import hashlib
+import weakref
+import sqlite3
+from astropy.coordinates import Angle, SkyCoord, Galactocentric, ICRS, search_around_sky
 from astropy import units as u
 from astroquery.simbad import Simbad
 from astroquery.vizier import Vizier
@@ -21,6 +24,18 @@ from tabulate import tabulate
 import math
 import shutil
 import h5py
+try:
+    import numba
+    _has_numba=True
+except ImportError: _has_numba=False
+try:
+    from astropy_healpix import HEALPix
+    _has_healpix=True
+except ImportError: _has_healpix=False
+try:
+    import pyarrow
+    _has_pyarrow=True
+except ImportError: _has_pyarrow=False
 
 
 def nan_helper(y):
@@ -198,6 +213,58 @@ def app_to_abs_mag(app_mag,parallax,app_mag_error=None,parallax_error=None):
             
     return result #se l'input è un array 1D, non c'è errore ed è un unico filtro
 
+def phot_quality_mask(phot,phot_filters,flags,par=None):
+    """
+    applies the photometric quality cuts based on the flags returned by search_phot, and returns
+    a boolean mask with the same shape as phot: True if the magnitude can be used, False if it must be discarded.
+    It is computed once per sample and can be passed to isochronal_age (keyword quality_mask) for any model.
+    Cuts:
+        2MASS J, H, K: the corresponding character of 'qfl' must be 'A';
+        Gaia EDR3 (DR2) Gbp, Grp: |corrected BP/RP excess factor| must be below 3 sigma of the expected scatter,
+            which depends on the G (G2) magnitude (Riello et al. 2020);
+        ALLWISE W1-W4 (WISE W1_w-W4_w): the corresponding character of 'ccf' ('ccf_w') must be '0'.
+    A cut is skipped if the survey is not present in "flags". Missing photometry is left to the fitting routines.
+
+    input:
+        phot: apparent magnitudes, a 2D numpy array with one row per star (output of search_phot)
+        phot_filters: names of the columns of phot
+        flags: dictionary of quality flags (output of search_phot)
+        par (optional): parallaxes [mas]. If given, the G magnitude entering the excess factor threshold is
+            converted to absolute, as done by isochronal_age. Default: None
+
+    usage:
+        good=phot_quality_mask(phot,headers[0],flags,par=par)
+        a,m=isochronal_age(phot,phot_err,headers[0],par,par_err,flags,iso,surveys,quality_mask=good)
+    """
+    phot_filters=np.array(phot_filters)
+    n=len(phot)
+    good=np.ones(phot.shape,dtype=bool)
+
+    def column(f):
+        w,=np.where(phot_filters==f)
+        return w
+
+    def char_flags(flag,n_char,ok):
+        c=np.array(flag,dtype='U'+str(n_char)).reshape(n,1).view('U1') #un carattere per colonna
+        return c==ok
+
+    if '2MASS' in flags and 'qfl' in flags['2MASS']:
+        ok=char_flags(flags['2MASS']['qfl'],3,'A')
+        for j,f in enumerate(['J','H','K']): good[:,column(f)]&=ok[:,j:j+1]
+    for survey,key,f_g,f_bprp,c in [['GAIA_EDR3','edr3_bp_rp_excess_factor_corr','G',['Gbp','Grp'],[0.0059898,8.817481e-12,7.618399]],
+                                   ['GAIA_DR2','dr2_bp_rp_excess_factor_corr','G2',['Gbp2','Grp2'],[0.004,8e-12,7.55]]]:
+        if survey not in flags or key not in flags[survey] or len(column(f_g))==0: continue
+        g=phot[:,column(f_g)[0]]
+        if type(par)!=type(None): g=app_to_abs_mag(g,par)
+        s1=c[0]+c[1]*g**c[2]
+        bad=abs(flags[survey][key])>3*s1
+        for f in f_bprp: good[:,column(f)]&=(bad==False)[:,None]
+    for survey,key,f_w in [['ALLWISE','ccf',['W1','W2','W3','W4']],['WISE','ccf_w',['W1_w','W2_w','W3_w','W4_w']]]:
+        if survey not in flags or key not in flags[survey]: continue
+        ok=char_flags(flags[survey][key],4,'0')
+        for j,f in enumerate(f_w): good[:,column(f)]&=ok[:,j:j+1]
+    return good
+
 
 
 def load_isochrones(model,surveys=['gaia','2mass','wise'],mass_range=[0.01,1.4],age_range=[1,1000],n_steps=[1000,500],feh=None,afe=None,v_vcrit=None,fspot=None,B=0):
@@ -508,7 +575,737 @@ def load_isochrones(model,surveys=['gaia','2mass','wise'],mass_range=[0.01,1.4],
 
     return mnew,anew,fnew,iso_f
 
-def isochronal_age(phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,surveys,border_age=False,ebv=None,verbose=False,output=None):
+def grid_marginals(chi2,mnew,anew):
+    """
+    turns a chi-square surface computed over an isochrone grid (masses, ages) into a likelihood
+    L=exp(-chi2/2), and returns its normalized marginal distributions in mass and age.
+    Each grid cell is given the same prior weight, i.e. the prior is flat in mass and in log(age)
+    for grids created by load_isochrones. NaN cells do not contribute.
+
+    input:
+        chi2: a 2D numpy array (len(mnew),len(anew))
+        mnew: grid masses
+        anew: grid ages
+
+    usage:
+        m_pdf,a_pdf=grid_marginals(chi2,mnew,anew)
+        m_pdf[k] is the probability of the k-th grid mass, a_pdf[k] that of the k-th grid age.
+        If no valid cell is present, two arrays of NaNs are returned.
+    """
+
+    c0=np.nanmin(chi2) if np.isfinite(chi2).any() else np.nan
+    if np.isnan(c0): return np.full(len(mnew),np.nan),np.full(len(anew),np.nan)
+    like=np.exp(-0.5*(chi2-c0))
+    like[np.isnan(like)]=0
+    m_pdf=np.sum(like,axis=1)
+    a_pdf=np.sum(like,axis=0)
+    norm=np.sum(m_pdf)
+    return m_pdf/norm,a_pdf/norm
+
+def pdf_percentiles(pdf,grid,percentiles=[16,50,84]):
+    """
+    given a discrete probability distribution "pdf" defined over the monotonic increasing array "grid",
+    returns the values of "grid" corresponding to the required "percentiles" (linear interpolation of the CDF).
+    """
+    if np.isnan(pdf).all(): return np.full(len(percentiles),np.nan)
+    cdf=np.cumsum(pdf)
+    return np.interp(np.array(percentiles)/100.,cdf/cdf[-1],grid)
+
+_iso_cache={} #strutture derivate dalle griglie di isocrone, indicizzate per griglia
+
+def _grid_cache(iso):
+    """
+    returns the dictionary where the structures derived from the isochrone grid iso[3] are stored.
+    The cache only holds a weak reference to the grid: its entry is removed as soon as the grid is freed.
+    """
+    key=id(iso[3])
+    if key not in _iso_cache: _iso_cache[key]={'finalizer':weakref.finalize(iso[3],_iso_cache.pop,key,None)}
+    return _iso_cache[key]
+
+def clear_grid_cache():
+    """
+    empties the cache of the structures derived from the isochrone grids (flux grids, pyramids, rasters, binary grids...),
+    releasing their memory. They are rebuilt when needed.
+    """
+    for cache in _iso_cache.values(): cache['finalizer'].detach()
+    _iso_cache.clear()
+
+def binary_grid(iso,q=[0,0.2,0.4,0.6,0.8,1],path=None):
+    """
+    augments an isochrone grid with unresolved binaries: for every mass ratio q, the fluxes of a primary of mass M
+    and of a secondary of mass q*M with the same age are summed in each filter. The mass ratio becomes an additional
+    axis of the grid, merged with the mass axis so that isochronal_age can search the new grid exactly as a single-star one.
+    Secondaries below the lowest mass of the grid are assumed to give no flux; the fluxes of the others are linearly
+    interpolated in mass. The result is cached alongside the grid and, if "path" is given, also saved to disk.
+
+    input:
+        iso: a tuple containing the output of load_isochrones
+        q (optional): list of mass ratios, between 0 (=single star) and 1. Default: [0,0.2,0.4,0.6,0.8,1]
+        path (optional): folder where the augmented grid is stored as a .pkl file, whose name depends on a hash of
+            the grid and of q. If the file exists, it is loaded instead of being computed. Default: None (=no disk cache)
+
+    usage:
+        iso_b=binary_grid(iso,q=np.linspace(0,1,11))
+        a,m,q=isochronal_age(phot,phot_err,headers[0],par,par_err,flags,iso_b,surveys)
+        iso_b is a tuple (masses, ages, filters, grid, mass ratios), where grid has len(q)*len(masses) rows,
+        ordered by mass ratio first. masses and mass ratios give the primary mass and the mass ratio of each row.
+        With this grid, isochronal_age returns the primary masses and the mass ratios as a further output.
+
+    notes:
+    the memory required by the augmented grid is len(q) times that of iso[3].
+    """
+    q=np.array(q,dtype=float)
+    if np.any(q<0) or np.any(q>1): raise ValueError('Mass ratios must be between 0 and 1.')
+    cache=_grid_cache(iso)
+    key=('binary',tuple(q))
+    if key in cache: return cache[key]
+    mnew,anew,fnew,grid=iso[0],iso[1],iso[2],iso[3]
+
+    PIK=None
+    if type(path)!=type(None):
+        h=hashlib.sha1()
+        h.update(_grid_hash(iso).encode())
+        h.update(q.tobytes())
+        PIK=os.path.join(path,'binary_grid_'+h.hexdigest()[:16]+'.pkl')
+        if file_search(PIK):
+            with open(PIK,'rb') as f:
+                iso_b=pickle.load(f)
+            cache[key]=iso_b
+            return iso_b
+
+    n_m=len(mnew)
+    flux=10.**(-0.4*grid)
+    grid_b=np.empty([len(q)*n_m,len(anew),len(fnew)])
+    for k in range(len(q)):
+        if q[k]==0: #stella singola: griglia originale
+            grid_b[k*n_m:(k+1)*n_m]=grid
+            continue
+        m2=q[k]*mnew
+        i0=np.clip(np.searchsorted(mnew,m2,side='right')-1,0,n_m-2)
+        t=((m2-mnew[i0])/(mnew[i0+1]-mnew[i0]))[:,None,None]
+        f2=np.where(t==0,flux[i0],np.where(t==1,flux[i0+1],flux[i0]*(1-t)+flux[i0+1]*t))
+        f2[m2<mnew[0]]=0. #secondarie sotto la massa minima: flusso trascurabile
+        grid_b[k*n_m:(k+1)*n_m]=-2.5*np.log10(flux+f2)
+    iso_b=(np.tile(mnew,len(q)),anew,fnew,grid_b,np.repeat(q,n_m))
+
+    if type(PIK)!=type(None):
+        with open(PIK,'wb') as f:
+            pickle.dump(iso_b,f)
+    cache[key]=iso_b
+    return iso_b
+
+def isochrone_pyramid(iso,factor=4,n_levels=3):
+    """
+    builds a pyramid of flux envelopes of an isochrone grid, to be used for coarse-to-fine searches.
+    At level k the grid is divided into blocks of factor**k x factor**k points (masses x ages), and for every block
+    the minimum and maximum flux 10**(-0.4*mag) of each filter are stored. They give a lower bound of the chi-square
+    of all the points of a block. The pyramid is built once per grid and cached alongside it.
+
+    input:
+        iso: a tuple containing the output of load_isochrones
+        factor (optional): downsampling factor between consecutive levels. Default: 4
+        n_levels (optional): number of levels, including the full grid. Default: 3
+
+    usage:
+        pyr=isochrone_pyramid(iso)
+        returns a list of (stride, flux_min, flux_max) tuples, from the coarsest level to the one with stride=factor,
+        where flux_min and flux_max have shape (blocks in mass, blocks in age, filters).
+    """
+    cache=_grid_cache(iso)
+    key=('pyramid',factor,n_levels)
+    if key not in cache:
+        flux=10.**(-0.4*iso[3])
+        l=flux.shape
+        pyr=[]
+        for k in range(n_levels-1,0,-1):
+            s=factor**k
+            nb=(-(-l[0]//s),-(-l[1]//s))
+            pad=np.full([nb[0]*s,nb[1]*s,l[2]],np.nan)
+            pad[:l[0],:l[1]]=flux
+            pad=pad.reshape(nb[0],s,nb[1],s,l[2])
+            pyr.append((s,np.fmin.reduce(np.fmin.reduce(pad,axis=3),axis=1),np.fmax.reduce(np.fmax.reduce(pad,axis=3),axis=1))) #i NaN sono ignorati
+        cache[key]=pyr
+    return cache[key]
+
+def _pyramid_min(pyr,flux,k0,k1,f0,f1,m0,m1,e0,e1,max_frac=0.25):
+    """
+    branch-and-bound search of the minimum of the chi-square of a channel over a pyramid built by isochrone_pyramid.
+    flux is the flux grid of isochronal_age (_flux_grid), k0 and k1 its indices for the two filters of the channel,
+    f0 and f1 the indices of the same filters in the grid (and in the pyramid).
+    Starting from the coarsest level, a block is discarded if the lower bound of its chi-square, derived from the
+    flux envelopes, is larger than the chi-square of a grid point already evaluated; the remaining blocks are split
+    into the blocks of the next level, down to single grid points. The minimum is therefore the same as that of
+    a full search, with the same tie-breaking.
+    Returns (chi2_min,(i_mass,i_age)) on the full grid, or None if there is no valid point or more than
+    max_frac of the grid should be evaluated: in that case, the caller should perform a full search.
+    """
+    c0=10.**(0.4*m0)
+    c1=10.**(0.4*m1)
+    l=flux[k0].shape
+
+    def bound(fmin,fmax,c,e): #minimo di sigma**2 con flusso in [fmin,fmax]: sigma è monotona nel flusso
+        lo=(fmin*c-1.)/e
+        hi=(fmax*c-1.)/e
+        b=np.where(lo>0,lo,np.where(hi<0,-hi,0.))
+        return b*b
+
+    def chi2(ii,jj): #come _sigma_into e _chi2_into
+        s0=(flux[k0][ii,jj]*c0-1.)/e0
+        s1=(flux[k1][ii,jj]*c1-1.)/e1
+        cr=s0*s0+s1*s1
+        cr[np.isnan(cr)]=np.inf
+        return cr
+
+    s,fmin,fmax=pyr[0]
+    bi,bj=np.indices(fmin.shape[:2])
+    bi=bi.ravel()
+    bj=bj.ravel()
+    best=np.inf
+    for lev in range(len(pyr)+1):
+        if lev>0: #divide i blocchi rimasti in quelli del livello successivo
+            s_new=pyr[lev][0] if lev<len(pyr) else 1
+            r=s//s_new
+            bi=(bi[:,None]*r+np.repeat(np.arange(r),r)[None,:]).ravel()
+            bj=(bj[:,None]*r+np.tile(np.arange(r),r)[None,:]).ravel()
+            s=s_new
+            w,=np.where((bi*s<l[0]) & (bj*s<l[1]))
+            bi=bi[w]
+            bj=bj[w]
+            if len(bi)*s*s>max_frac*l[0]*l[1]: return None
+        if s==1: break
+        fmin,fmax=pyr[lev][1],pyr[lev][2]
+        lb=bound(fmin[bi,bj,f0],fmax[bi,bj,f0],c0,e0)+bound(fmin[bi,bj,f1],fmax[bi,bj,f1],c1,e1)
+        lb[np.isnan(lb)]=np.inf #blocchi senza punti validi
+        best=min(best,np.min(chi2(bi*s,bj*s),initial=np.inf)) #il primo punto di ogni blocco dà un limite superiore
+        w,=np.where(lb<=best)
+        bi=bi[w]
+        bj=bj[w]
+    cr=chi2(bi,bj)
+    if len(cr)==0 or np.isinf(np.min(cr)): return None
+    w,=np.where(cr==np.min(cr))
+    k=w[np.argmin(bi[w]*l[1]+bj[w])] #a parità di chi quadro, il primo punto come in _argmin_inplace
+    return cr[k],(bi[k],bj[k])
+
+def _filter_major(iso,filt):
+    """
+    returns a contiguous copy of the isochrone grid restricted to the filters "filt", with shape
+    (filters, masses, ages), so that the grid of each filter is a contiguous block. Cached alongside the grid.
+    """
+    cache=_grid_cache(iso)
+    key=('filter_major',tuple(filt))
+    if key not in cache: cache[key]=np.ascontiguousarray(np.moveaxis(iso[3][:,:,filt],2,0))
+    return cache[key]
+
+def _flux_grid(iso,filt):
+    """
+    returns the fluxes 10**(-0.4*mag) of the isochrone grid restricted to the filters "filt", with the same layout
+    as _filter_major. The flux distance of a star from every grid point then costs a single product per filter,
+    independently of the number of channels the filter is used in. Cached alongside the grid.
+    """
+    cache=_grid_cache(iso)
+    key=('flux',tuple(filt))
+    if key not in cache: cache[key]=10.**(-0.4*_filter_major(iso,filt))
+    return cache[key]
+
+def _fit_workspace(shape,n_filt,n_chan):
+    """
+    allocates the buffers used by the fitting kernel of isochronal_age for a grid of (masses, ages)="shape".
+    They are allocated once per call and reused for every star.
+    """
+    return {'sigma':np.full([n_filt,shape[0],shape[1]],np.nan), #distanze fotometriche per filtro
+            'cr':np.zeros([n_chan,shape[0],shape[1]]), #chi quadro per canale
+            'tmp':np.empty(shape),
+            'mask':np.empty(shape,dtype=bool),
+            'tmp_t':np.empty([shape[1],shape[0]]), #trasposti (età, masse), per le ricerche lungo le isocrone
+            'mask_t':np.empty([shape[1],shape[0]],dtype=bool),
+            'q':np.arange(shape[1])}
+
+def _sigma_into(flux_k,mag,e,out):
+    """
+    in-place computation of the flux distance (10**(-0.4*(grid_k-mag))-1)/e of a star from every grid point,
+    starting from the precomputed grid of fluxes flux_k=10**(-0.4*grid_k) (see _flux_grid)
+    """
+    np.multiply(flux_k,10.**(0.4*mag),out=out)
+    np.subtract(out,1.,out=out)
+    np.divide(out,e,out=out)
+    return out
+
+def _chi2_into(s0,s1,out,tmp):
+    """in-place computation of the chi-square s0**2+s1**2 of a channel"""
+    np.square(s0,out=out)
+    np.square(s1,out=tmp)
+    np.add(out,tmp,out=out)
+    return out
+
+if _has_numba:
+    @numba.njit(cache=True,nogil=True) #senza GIL: i modelli di isochronal_age_ensemble sono fittati in parallelo
+    def _chi2_min_numba(flux0,flux1,c0,c1,e0,e1):
+        """
+        fused version of _sigma_into, _chi2_into and _argmin_inplace for a channel, with c=10**(0.4*mag):
+        a single pass over the grid, without intermediate arrays. The operations are the same, in the same order,
+        so the result is identical. Returns (chi2_min, i_mass, i_age); chi2_min is +inf if no grid point is valid.
+        """
+        best=np.inf
+        bi=0
+        bj=0
+        for i in range(flux0.shape[0]):
+            for j in range(flux0.shape[1]):
+                s0=(flux0[i,j]*c0-1.)/e0
+                s1=(flux1[i,j]*c1-1.)/e1
+                v=s0*s0+s1*s1
+                if v<best: #falso per i NaN: come sostituirli con +inf; a parità, vale il primo
+                    best=v
+                    bi=i
+                    bj=j
+        return best,bi,bj
+
+def _argmin_inplace(cr,mask):
+    """
+    same as min_v(cr), but NaNs are replaced by +inf directly in cr to avoid temporary copies.
+    If cr contains only NaNs, the returned minimum is +inf.
+    """
+    np.isnan(cr,out=mask)
+    np.copyto(cr,np.inf,where=mask)
+    ind=np.unravel_index(np.argmin(cr),cr.shape)
+    return cr[ind],ind
+
+def _buffer(buf,shape):
+    """returns a contiguous view of the first elements of the workspace buffer "buf", with the given shape"""
+    return buf.reshape(-1)[:shape[0]*shape[1]].reshape(shape)
+
+def _mag_index(iso,filt):
+    """
+    builds, for each filter in "filt", the magnitude envelope of every mass row (min and max over ages)
+    and of every isochrone (min and max over masses) of the grid. It allows to find, in O(masses+ages) operations,
+    the sub-rectangle of the grid containing all the points within a given magnitude window. Cached alongside the grid.
+    """
+    cache=_grid_cache(iso)
+    key=('mag_index',tuple(filt))
+    if key not in cache:
+        grid=_filter_major(iso,filt)
+        cache[key]={'row_min':np.fmin.reduce(grid,axis=2),'row_max':np.fmax.reduce(grid,axis=2),
+                    'col_min':np.fmin.reduce(grid,axis=1),'col_max':np.fmax.reduce(grid,axis=1)}
+    return cache[key]
+
+def _window_rect(index,filters,mags,windows):
+    """
+    returns the boundaries (r0,r1,c0,c1) of the smallest sub-rectangle grid[r0:r1,c0:c1] containing every grid point
+    whose magnitude is within windows[k] from mags[k] in each filter[k], or None if there is none.
+    """
+    rows=True
+    cols=True
+    for k in range(len(filters)):
+        f=filters[k]
+        lo=mags[k]-windows[k]
+        hi=mags[k]+windows[k]
+        rows=rows & (index['row_min'][f]<=hi) & (index['row_max'][f]>=lo)
+        cols=cols & (index['col_min'][f]<=hi) & (index['col_max'][f]>=lo)
+    r,=np.nonzero(rows)
+    c,=np.nonzero(cols)
+    if len(r)==0 or len(c)==0: return None
+    return r[0],r[-1]+1,c[0],c[-1]+1
+
+def _window_min(flux,index,k0,k1,m0,m1,e0,e1,w0,w1,ws):
+    """
+    minimum of the chi-square of a channel (k0,k1), evaluated only within the sub-rectangle of the grid where the
+    magnitudes are within (w0,w1) from the observed ones (m0,m1). Every point outside it has a chi-square larger
+    than the returned bound: if the minimum found is not below it, None is returned and a full search is needed.
+    Returns (chi2_min,(i_mass,i_age)) on the full grid, as min_v.
+    """
+    rect=_window_rect(index,[k0,k1],[m0,m1],[w0,w1])
+    if type(rect)==type(None): return None
+    r0,r1,c0,c1=rect
+    shape=(r1-r0,c1-c0)
+    s0=_sigma_into(flux[k0,r0:r1,c0:c1],m0,e0,_buffer(ws['tmp'],shape))
+    s1=_sigma_into(flux[k1,r0:r1,c0:c1],m1,e1,_buffer(ws['tmp_t'],shape))
+    np.square(s0,out=s0)
+    np.square(s1,out=s1)
+    np.add(s0,s1,out=s0)
+    est,ind=_argmin_inplace(s0,_buffer(ws['mask'],shape))
+    bound=min(((1-10.**(-0.4*w0))/e0)**2,((1-10.**(-0.4*w1))/e1)**2) #chi quadro minimo fuori dalla finestra
+    if (est<bound)==False: return None
+    return est,(r0+ind[0],c0+ind[1])
+
+def _iso_crossing(grid0,grid1,mag,ws=None,max_diff=0.1):
+    """
+    for each isochrone (column) of grid0, finds the grid point closest to "mag" and returns
+    its magnitude in the second filter of the channel (grid1), NaN if the distance is larger than max_diff,
+    together with the (signed) minimum distances. If a workspace "ws" is given, its buffers are used.
+    """
+    if type(ws)==type(None): ws=_fit_workspace(grid0.shape,0,0)
+    sh=(grid0.shape[1],grid0.shape[0])
+    ad=_buffer(ws['tmp_t'],sh)
+    mask=_buffer(ws['mask_t'],sh)
+    np.subtract(grid0.T,mag,out=ad)
+    np.abs(ad,out=ad)
+    np.isnan(ad,out=mask)
+    np.copyto(ad,np.inf,where=mask)
+    im0=np.argmin(ad,axis=1)
+    q=ws['q'][:sh[0]]
+    asa=grid0[im0,q]-mag
+    colth=np.where(np.abs(asa)<max_diff,grid1[im0,q],np.nan)
+    return colth,asa
+
+def cmd_raster(iso,f0,f1,pixel=0.02,tol=0.05):
+    """
+    builds a raster of the color-magnitude plane of the channel (f0,f1) of an isochrone grid: every pixel, i.e. every pair
+    of magnitudes (mag in f0, mag in f1), is mapped to the closest grid point in magnitude space, if closer than tol.
+    The closest points are found through a KD-tree of the grid, whose search is stopped at tol.
+    The raster is built once per grid, channel, pixel and tol, and cached.
+
+    input:
+        iso: a tuple containing the output of load_isochrones
+        f0, f1: indices of the two filters in iso[2]
+        pixel (optional): size of a pixel [mag]. Default: 0.02
+        tol (optional): maximum distance [mag] from the closest grid point. Default: 0.05
+
+    usage:
+        r=cmd_raster(iso,5,0)
+        returns a dictionary with keys 'start' (magnitudes of the center of the first pixel), 'pixel'
+        and 'cell' (2D array of the flattened (mass, age) index of the closest grid point, -1 if farther than tol).
+        For a star with magnitudes (m0,m1), the pixel is (round((m0-start[0])/pixel), round((m1-start[1])/pixel)).
+    """
+    cache=_grid_cache(iso)
+    key=('raster',f0,f1,pixel,tol)
+    if key not in cache:
+        from scipy.spatial import cKDTree
+        g0=iso[3][:,:,f0].ravel()
+        g1=iso[3][:,:,f1].ravel()
+        cells,=np.where(np.isfinite(g0) & np.isfinite(g1))
+        tree=cKDTree(np.column_stack((g0[cells],g1[cells])))
+        start=np.array([np.min(g0[cells]),np.min(g1[cells])])-5*pixel
+        n=(np.ceil((np.array([np.max(g0[cells]),np.max(g1[cells])])+5*pixel-start)/pixel)).astype(int)+1
+        cell=np.empty(n,dtype=np.int64)
+        x1=start[1]+pixel*np.arange(n[1])
+        step=max(1,2**20//n[1])
+        for i in range(0,n[0],step): #blocchi di righe di pixel, per limitare la memoria
+            x0=start[0]+pixel*np.arange(i,min(i+step,n[0]))
+            d,k=tree.query(np.column_stack((np.repeat(x0,n[1]),np.tile(x1,len(x0)))),distance_upper_bound=tol)
+            far=np.isinf(d)
+            k[far]=0
+            cell[i:i+len(x0)]=np.where(far,-1,cells[k]).reshape(len(x0),n[1])
+        cache[key]={'start':start,'pixel':pixel,'cell':cell}
+    return cache[key]
+
+def _raster_lookup(raster,m0,m1):
+    """
+    flattened grid index of the closest grid point for stars with magnitudes (m0,m1), read from a cmd_raster.
+    It is -1 where the star falls outside the raster or too far from the grid, where an exact fit is needed.
+    """
+    i=np.rint((m0-raster['start'][0])/raster['pixel'])
+    j=np.rint((m1-raster['start'][1])/raster['pixel'])
+    n=raster['cell'].shape
+    ok=np.isfinite(i) & np.isfinite(j)
+    ok[ok]=(i[ok]>=0) & (i[ok]<n[0]) & (j[ok]>=0) & (j[ok]<n[1])
+    res=np.full(len(m0),-1,dtype=np.int64)
+    i=i[ok].astype(int)
+    j=j[ok].astype(int)
+    res[ok]=raster['cell'][i,j]
+    return res
+
+def _phot_bitmask(phot,phot_err,max_phot_err=0.1):
+    """
+    same as is_phot_good, applied to every row of the 2D arrays phot and phot_err at once.
+    Returns, for each star, an integer whose k-th bit is set if the k-th filter has valid photometry.
+    """
+    good=(np.isnan(phot)==False) & (phot_err < max_phot_err) & (abs(phot) < 70)
+    return np.sum(good.astype(np.int64) << np.arange(phot.shape[1]),axis=1)
+
+def _batch_workspace(shape,n_filt,batch_size):
+    """allocates the buffers used by _batch_min for batches of up to batch_size stars"""
+    return {'sigma':np.empty([n_filt,batch_size,shape[0],shape[1]]),
+            'cr':np.empty([batch_size,shape[0],shape[1]]),
+            'tmp':np.empty([batch_size,shape[0],shape[1]]),
+            'mask':np.empty([batch_size,shape[0],shape[1]],dtype=bool)}
+
+def _batch_min(flux,wc,mags,errs,ws):
+    """
+    chi-square minima of the channels wc[:,j] for a batch of stars, each computed as in _sigma_into, _chi2_into
+    and _argmin_inplace, but with a single array operation for the whole batch.
+    mags and errs are (stars, filters) arrays of magnitudes and flux errors; only the filters in wc are used.
+    Returns est (stars, channels), +inf where the grid has no valid point, and ind (stars, channels, 2).
+    """
+    b=len(mags)
+    n_ch=wc.shape[1]
+    l=flux.shape[1:]
+    est=np.full([b,n_ch],np.inf)
+    ind=np.zeros([b,n_ch,2],dtype=int)
+    cr=ws['cr'][:b]
+    tmp=ws['tmp'][:b]
+    mask=ws['mask'][:b]
+    for k in np.unique(wc):
+        s=ws['sigma'][k,:b]
+        fac=np.array([10.**(0.4*m) for m in mags[:,k]])
+        np.multiply(flux[k],fac[:,None,None],out=s)
+        np.subtract(s,1.,out=s)
+        np.divide(s,errs[:,k][:,None,None],out=s)
+    for j in range(n_ch):
+        np.square(ws['sigma'][wc[0,j],:b],out=cr)
+        np.square(ws['sigma'][wc[1,j],:b],out=tmp)
+        np.add(cr,tmp,out=cr)
+        np.isnan(cr,out=mask)
+        np.copyto(cr,np.inf,where=mask)
+        q=np.argmin(cr.reshape(b,-1),axis=1)
+        est[:,j]=cr.reshape(b,-1)[np.arange(b),q]
+        ind[:,j,0],ind[:,j,1]=np.unravel_index(q,l)
+    return est,ind
+
+def _batch_crossing(grid0,grid1,mags,ws,max_diff=0.1):
+    """
+    same as _iso_crossing for a batch of magnitudes "mags", using the buffers of a _batch_workspace.
+    Instead of the full arrays, returns for each star the values of min(colth), max(colth) and min(asa,key=abs),
+    reproducing the behaviour of the builtin functions with NaNs (the result is NaN if the first element is NaN).
+    """
+    b=len(mags)
+    sh=(b,grid0.shape[1],grid0.shape[0])
+    ad=ws['tmp'].reshape(-1)[:b*sh[1]*sh[2]].reshape(sh)
+    mask=ws['mask'].reshape(-1)[:b*sh[1]*sh[2]].reshape(sh)
+    np.subtract(grid0.T[None,:,:],mags[:,None,None],out=ad)
+    np.abs(ad,out=ad)
+    np.isnan(ad,out=mask)
+    np.copyto(ad,np.inf,where=mask)
+    im0=np.argmin(ad,axis=2)
+    q=np.arange(sh[1])[None,:]
+    asa=grid0[im0,q]-mags[:,None]
+    colth=np.where(np.abs(asa)<max_diff,grid1[im0,q],np.nan)
+    first=np.isnan(colth[:,0])
+    c_min=np.where(first,np.nan,np.fmin.reduce(colth,axis=1))
+    c_max=np.where(first,np.nan,np.fmax.reduce(colth,axis=1))
+    k=np.argmin(np.where(np.isnan(asa),np.inf,np.abs(asa)),axis=1)
+    asb=np.where(np.isnan(asa[:,0]),np.nan,asa[np.arange(b),k])
+    return c_min,c_max,asb
+
+def _av_min(flux,wc,mags,errs,coef,av_grid,ws,step=None):
+    """
+    joint fit of the extinction A_V for a single star. For a given A_V, the star is dereddened by coef*A_V in every filter
+    (which is equivalent to reddening the grid) and the chi-square minimum of each channel wc[:,j] is found over the grid.
+    A_V is chosen as the step of av_grid minimizing the sum of the channel minima: the sum is computed on every "step"-th
+    element of av_grid, then on every element around the best coarse one, so that the cost grows as sqrt(len(av_grid)).
+    Returns (A_V, est, ind), with est (channels) and ind (channels, 2) as in _argmin_inplace.
+    """
+    n=len(av_grid)
+    if type(step)==type(None): step=max(1,int(np.sqrt(n)))
+    res={}
+
+    def evaluate(k):
+        if k in res: return res[k][0]
+        m=mags-coef*av_grid[k]
+        est=np.full(wc.shape[1],np.inf)
+        ind=np.zeros([wc.shape[1],2],dtype=int)
+        for f in np.unique(wc): _sigma_into(flux[f],m[f],errs[f],ws['sigma'][f])
+        for j in range(wc.shape[1]):
+            _chi2_into(ws['sigma'][wc[0,j]],ws['sigma'][wc[1,j]],ws['cr'][j],ws['tmp'])
+            est[j],ind[j]=_argmin_inplace(ws['cr'][j],ws['mask'])
+        w=np.isinf(est)==False
+        res[k]=(np.sum(est[w]) if w.any() else np.inf,est,ind)
+        return res[k][0]
+
+    coarse=list(range(0,n,step))
+    if coarse[-1]!=n-1: coarse.append(n-1)
+    k0=coarse[int(np.argmin([evaluate(k) for k in coarse]))]
+    for k in range(max(0,k0-step+1),min(n,k0+step)): evaluate(k)
+    keys=sorted(res)
+    k1=keys[int(np.argmin([res[k][0] for k in keys]))]
+    return av_grid[k1],res[k1][1],res[k1][2]
+
+def preprocess_phot(phot_app,phot_err_app,phot_filters,par,par_err,flags,ebv=None,quality_mask=None):
+    """
+    prepares the photometry of a sample for isochronal_age, independently of the model: converts it to absolute magnitudes
+    and discards the magnitudes excluded by the quality cuts (see phot_quality_mask). The extinction in each filter
+    is computed only when first required by a fit, and then stored in the returned dictionary.
+
+    input:
+        phot_app, phot_err_app, phot_filters, par, par_err, flags: as in isochronal_age
+        ebv (optional): color excess E(B-V) of the sources. Default: None (=no extinction correction)
+        quality_mask (optional): the output of phot_quality_mask. Default: None (=computed from flags)
+
+    usage:
+        prep=preprocess_phot(phot,phot_err,headers[0],par,par_err,flags,ebv=ebv)
+        a,m=isochronal_age(phot,phot_err,headers[0],par,par_err,flags,iso,surveys,preprocessed=prep)
+        returns a dictionary with keys 'phot' and 'phot_err' (absolute magnitudes and their errors, NaN where excluded),
+        'filters', 'ebv' and 'red' (extinction per filter).
+    """
+    phot,phot_err=app_to_abs_mag(phot_app,par,app_mag_error=phot_err_app,parallax_error=par_err)
+    if type(quality_mask)==type(None): quality_mask=phot_quality_mask(phot_app,phot_filters,flags,par=par)
+    phot[quality_mask==False]=np.nan
+    phot_err[quality_mask==False]=np.nan
+    return {'phot':phot,'phot_err':phot_err,'filters':np.array(phot_filters),'ebv':ebv,'red':{}}
+
+def _prep_extinction(prep,f):
+    """extinction in the filter f for the stars of a preprocess_phot dictionary, computed once and stored there"""
+    if f not in prep['red']: prep['red'][f]=extinction(prep['ebv'],f)
+    return prep['red'][f]
+
+def _grid_hash(iso):
+    """hexadecimal SHA-1 digest of the content of an isochrone grid tuple, computed once and cached alongside the grid"""
+    cache=_grid_cache(iso)
+    if 'sha1' not in cache:
+        h=hashlib.sha1()
+        for x in iso: h.update(np.ascontiguousarray(np.array(x)).tobytes())
+        cache['sha1']=h.hexdigest()
+    return cache['sha1']
+
+def _star_keys(phot_app,phot_err_app,phot_filters,par,par_err,flags,ebv,iso,settings,quality_mask=None,preprocessed=None):
+    """
+    returns, for each star, a SHA-1 digest of everything its fit depends on: the isochrone grid, the fitting settings,
+    its photometry, errors, parallax, E(B-V) and quality flags, and its row of quality_mask or of preprocessed
+    (see isochronal_age) if given.
+    """
+    n=len(par)
+    base=hashlib.sha1()
+    base.update(_grid_hash(iso).encode())
+    base.update(repr(settings).encode())
+    base.update(np.array(phot_filters,dtype=str).tobytes())
+    ebv=np.broadcast_to(np.array(np.nan if type(ebv)==type(None) else ebv,dtype=float),(n,))
+    fl=[np.asarray(flags[s][k]) for s in sorted(flags) for k in sorted(flags[s])]
+    phot_app=np.ascontiguousarray(phot_app,dtype=float)
+    phot_err_app=np.ascontiguousarray(phot_err_app,dtype=float)
+    rows=[] #righe che sostituiscono il calcolo a partire dai flag
+    if type(preprocessed)!=type(None):
+        base.update(np.array(preprocessed['filters'],dtype=str).tobytes())
+        rows=[np.ascontiguousarray(preprocessed['phot'],dtype=float),np.ascontiguousarray(preprocessed['phot_err'],dtype=float)]
+    elif type(quality_mask)!=type(None): rows=[np.ascontiguousarray(quality_mask,dtype=bool)]
+    keys=[]
+    for i in range(n):
+        h=base.copy()
+        h.update(phot_app[i].tobytes())
+        h.update(phot_err_app[i].tobytes())
+        h.update(np.array([par[i],par_err[i],ebv[i]],dtype=float).tobytes())
+        for x in fl: h.update(str(x[i]).encode())
+        for x in rows: h.update(x[i].tobytes())
+        keys.append(h.hexdigest())
+    return keys
+
+def _memo_isochronal_age(store,settings,phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,surveys,ebv,quality_mask,preprocessed,kwargs):
+    """
+    runs isochronal_age only on the stars whose results are not in the pickle file "store", keyed by _star_keys,
+    and adds the new results to it. Returns the same outputs as isochronal_age.
+    """
+    if type(preprocessed)!=type(None): ebv=preprocessed['ebv']
+    keys=_star_keys(phot_app,phot_err_app,phot_filters,par,par_err,flags,ebv,iso,settings,quality_mask=quality_mask,preprocessed=preprocessed)
+    memo={}
+    if file_search(store):
+        with open(store,'rb') as f:
+            memo=pickle.load(f)
+    new=np.array([i for i in range(len(keys)) if keys[i] not in memo],dtype=int)
+    if len(new)>0:
+        def sub(x): return x if np.isscalar(x) or type(x)==type(None) else np.asarray(x)[new]
+        if type(preprocessed)!=type(None):
+            preprocessed={'phot':preprocessed['phot'][new],'phot_err':preprocessed['phot_err'][new],
+                          'filters':preprocessed['filters'],'ebv':sub(preprocessed['ebv']),'red':{}}
+        flags1={s:{k:np.asarray(flags[s][k])[new] for k in flags[s]} for s in flags}
+        res=isochronal_age(sub(phot_app),sub(phot_err_app),phot_filters,sub(par),sub(par_err),flags1,iso,surveys,
+                           ebv=sub(ebv),quality_mask=sub(quality_mask),preprocessed=preprocessed,**kwargs)
+        for r in range(len(new)): memo[keys[new[r]]]=tuple([x[r] for x in res])
+        with open(store+'.tmp','wb') as f: #scrittura atomica: il file precedente resta valido fino alla fine
+            pickle.dump(memo,f)
+        os.replace(store+'.tmp',store)
+    if len(keys)==0: return tuple([np.empty(0)]*(2+(type(kwargs['av_grid'])!=type(None))+(len(iso)>4))) #a,m[,av][,q]
+    return tuple([np.array([memo[k][j] for k in keys]) for j in range(len(memo[keys[0]]))])
+
+def isochronal_age(phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,surveys,border_age=False,ebv=None,verbose=False,output=None,posterior=False,percentiles=[16,50,84],pdf_bins=None,search='full',pyramid_factor=4,pyramid_levels=3,mag_window=None,channels=None,batch_size=None,quality_mask=None,preprocessed=None,av_grid=None,av_step=None,store=None,out_format='csv',raster_pixel=0.02,raster_tol=0.05,kernel='auto'):
+    """
+    estimates ages and masses of a sample of stars by comparing their photometry with a grid of isochrones.
+    By default, four color-magnitude channels are used: (G,K), (G,J), (G,H), (Gbp,Grp). For every star and channel the
+    best-fit grid cell is found; the final estimate is the mean over valid channels.
+
+    input:
+        phot_app: apparent magnitudes, a 2D numpy array with one row per star (output of search_phot)
+        phot_err_app: errors on phot_app
+        phot_filters: names of the columns of phot_app (first element of search_phot's headers)
+        par: parallaxes [mas]
+        par_err: errors on par
+        flags: dictionary of quality flags (output of search_phot)
+        iso: a tuple containing the output of load_isochrones, or of binary_grid to fit unresolved binaries
+        surveys: list of surveys used
+        border_age (optional): set to True to assign the minimum grid age to stars lying below the
+            youngest isochrone. Default: False
+        ebv (optional): color excess E(B-V) of the sources. Default: None (=no extinction correction)
+        verbose (optional): set to True to write the results to a file. Default: False
+        output (mandatory if verbose=True): a list [filename, model_name], used to name the output file
+        out_format (optional): format of the output file: 'csv', 'fits', 'hdf5', 'parquet' or 'txt' (see write_table).
+            Default: 'csv'
+        posterior (optional): set to True to also return marginal posterior distributions in mass and age,
+            derived from the same chi-square surfaces used for the best fit (see grid_marginals). Default: False
+        percentiles (optional): percentiles of the posterior to be returned if posterior=True.
+            Default: [16,50,84]
+        pdf_bins (optional): if an integer n is given, the marginal posteriors are also returned as histograms
+            with n fixed bins (linear in mass, logarithmic in age). Default: None
+        search (optional): 'full' to evaluate every grid cell, 'pyramid' to discard whole blocks of the grid whose
+            chi-square is provably larger than the best one found, from coarse to fine levels (see isochrone_pyramid).
+            The minimum is the same as with 'full'; the full search is performed anyway if too few blocks can be discarded.
+            'raster' to start from the grid point closest to the star in the color-magnitude plane, read from a precomputed
+            raster (see cmd_raster): its chi-square bounds the minimum, which is then searched only within the magnitude
+            window where the chi-square can be lower (as with mag_window). The minimum is the same as with 'full'.
+            Stars outside the raster or farther than raster_tol from the grid are fitted as with 'full'. Default: 'full'
+        pyramid_factor (optional): downsampling factor between pyramid levels. Default: 4
+        pyramid_levels (optional): number of pyramid levels, including the full grid. Default: 3
+        raster_pixel (optional): pixel size [mag] of the raster used if search='raster'. Default: 0.02
+        raster_tol (optional): maximum distance [mag] from the closest grid point for the raster to be used. Default: 0.05
+            raster_pixel and raster_tol only affect the speed of search='raster', not its results.
+        kernel (optional): 'numba' to perform the full search of each channel with a compiled kernel, that computes
+            the chi-square and its minimum in a single pass over the grid; 'numpy' to use array operations;
+            'auto' to use numba if installed. Results are identical. The chi-square surfaces needed by posterior=True
+            and the extinction search of av_grid are always computed with numpy. Default: 'auto'
+        mag_window (optional): if set to a number n, the chi-square of each star is evaluated only within the
+            sub-rectangle of the grid whose magnitudes are within n times the photometric error from the observed ones.
+            If the minimum found there is not guaranteed to be the global one, the full grid is used:
+            results are unchanged. Default: None (=no pruning)
+        channels (optional): list of the color-magnitude channels to be used. Each channel is a pair [f0,f1] of filter names:
+            isochrones are cut at constant magnitude in f0, while f1 is used for the color f1-f0. Any filter of the grid
+            can be used, e.g. [['K','G'],['W1','G'],['W2','G']]. If the isochrones have Gaia DR2 filters, 'G', 'Gbp' and 'Grp'
+            are automatically replaced by 'G2', 'Gbp2' and 'Grp2'. Default: [['K','G'],['J','G'],['H','G'],['Grp','Gbp']]
+        batch_size (optional): if set to an integer n, stars are grouped by the set of filters with valid photometry
+            and the chi-square minima of each group are computed n stars at a time with single array operations.
+            Results are unchanged. It requires about (no. of filters+3)*n*(no. of grid points)*8 bytes of memory.
+            Only available with search='full', no mag_window and posterior=False. Default: None (=one star at a time)
+        quality_mask (optional): the output of phot_quality_mask(phot_app,phot_filters,flags,par=par), to avoid recomputing it
+            when the same sample is fitted with several models. Default: None (=computed from flags)
+        preprocessed (optional): the output of preprocess_phot for the same sample. If given, the conversion to absolute
+            magnitudes and the quality cuts are not repeated, and ebv and quality_mask are ignored. Default: None
+        av_grid (optional): an array of extinction values A_V [mag]. If given, A_V is fitted together with mass and age
+            instead of being fixed by ebv: for every star, the value of av_grid minimizing the sum of the chi-square
+            minima of its channels is selected, and the channel estimates are those obtained with it.
+            The extinction in each filter is derived from A_V through the coefficients of extinction().
+            Not compatible with ebv, search='pyramid', mag_window, batch_size and posterior=True. Default: None
+        av_step (optional): A_V is first searched every av_step elements of av_grid, then at every element close
+            to the best one. Default: None (=sqrt(len(av_grid)))
+        store (optional): full path of a .pkl file where the results of every star are saved, keyed by a hash of
+            the isochrone grid, the fitting settings and the input data of the star (photometry, errors, parallax,
+            E(B-V), quality flags, and its row of quality_mask or preprocessed if given). Stars already present are not fitted again, so that only new or modified stars
+            are fitted when a sample is re-analyzed. Not compatible with verbose=True and posterior=True. Default: None
+
+    usage:
+        a,m=isochronal_age(phot,phot_err,headers[0],par,par_err,flags,iso,surveys,ebv=ebv)
+        returns the best-fit ages and masses.
+        a,m,post=isochronal_age(phot,phot_err,headers[0],par,par_err,flags,iso,surveys,ebv=ebv,posterior=True)
+        returns also a dictionary 'post' with keys 'age_percentiles' and 'mass_percentiles', each a
+        2D array (no. of stars, len(percentiles)), plus 'age_pdf', 'mass_pdf', 'age_bins', 'mass_bins'
+        if pdf_bins is set.
+        a,m,av=isochronal_age(phot,phot_err,headers[0],par,par_err,flags,iso,surveys,av_grid=np.arange(0,3.01,0.05))
+        returns also the best-fit A_V of each star (NaN if no channel was fitted).
+        a,m,q=isochronal_age(phot,phot_err,headers[0],par,par_err,flags,binary_grid(iso),surveys)
+        returns the primary masses and the mass ratios q of the stars (averaged over channels, as masses and ages).
+        If both av_grid and a binary grid are used, the outputs are a,m,av,q.
+
+    notes:
+    a channel is fitted only if both its filters have valid photometry.
+    the flux grid of each filter is computed once per isochrone grid: every filter adds one operation per grid point
+    and star, every channel one more (sum and minimum search).
+    search='pyramid', search='raster' and mag_window are not compatible with posterior=True, which needs the full chi-square surface.
+    the posterior of a star is the average of the normalized posteriors of its successfully fitted channels,
+    consistently with the final estimate being the mean of the channel estimates.
+    """
+
+    if type(store)!=type(None):
+        if verbose or posterior: raise ValueError('store is not compatible with verbose=True and posterior=True.')
+        settings={'border_age':border_age,'search':search,'pyramid_factor':pyramid_factor,'pyramid_levels':pyramid_levels,
+                  'mag_window':mag_window,'channels':channels,'av_step':av_step,'raster_pixel':raster_pixel,'raster_tol':raster_tol,
+                  'av_grid':None if type(av_grid)==type(None) else list(np.array(av_grid,dtype=float))} #tutto ciò che influenza i risultati
+        kwargs={'border_age':border_age,'search':search,'pyramid_factor':pyramid_factor,'pyramid_levels':pyramid_levels,
+                'mag_window':mag_window,'channels':channels,'batch_size':batch_size,'av_grid':av_grid,'av_step':av_step,
+                'raster_pixel':raster_pixel,'raster_tol':raster_tol,'kernel':kernel}
+        return _memo_isochronal_age(store,settings,phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,surveys,ebv,quality_mask,preprocessed,kwargs)
 
     mnew=iso[0]
     anew=iso[1]
@@ -520,79 +1317,60 @@ def isochronal_age(phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,surv
     ph_cut=0.2
     bin_frac=0.0
     
-    #trasformo fotometria in assoluta
-    phot,phot_err=app_to_abs_mag(phot_app,par,app_mag_error=phot_err_app,parallax_error=par_err)
+    #trasformo fotometria in assoluta e applico i tagli di qualità
+    if type(preprocessed)==type(None): preprocessed=preprocess_phot(phot_app,phot_err_app,phot_filters,par,par_err,flags,ebv=ebv,quality_mask=quality_mask)
+    phot,phot_err=preprocessed['phot'],preprocessed['phot_err']
 
     #raggi per peso della media
 
     #contaminazione in flusso
     cont=np.zeros(2) #contaminazione nei filtri 2MASS per le stelle, in questo caso nulla
 
+    if type(channels)==type(None): channels=[['K','G'],['J','G'],['H','G'],['Grp','Gbp']] #(G-K), (G-J), (G-H), (Gbp-Grp)
+    ch_names=[str(c[1])+'-'+str(c[0]) for c in channels]
     #selects Gaia DR2 photometry if the isochrones have DR2 filters, EDR3 otherwise
-    if 'G2' in fnew: f_right=['J','H','K','G2','Gbp2','Grp2'] #right order
-    else: f_right=['J','H','K','G','Gbp','Grp']
+    if 'G2' in fnew:
+        dr2={'G':'G2','Gbp':'Gbp2','Grp':'Grp2'}
+        channels=[[dr2.get(c[0],c[0]),dr2.get(c[1],c[1])] for c in channels]
+    f_right=[] #filtri usati, in ordine di apparizione
+    for c in channels:
+        for f in c:
+            if f not in f_right: f_right.append(f)
+    for f in f_right:
+        if f not in fnew: raise ValueError('Filter '+f+' not available in the isochrone grid.')
+        if f not in phot_filters: raise ValueError('Filter '+f+' not available in the photometry.')
 
     l0=phot.shape
     xlen=l0[0] #no. of stars: 85
     ylen=len(f_right) #no. of filters: 6
+    n_ch=len(channels) #no. of channels: 4
 
     filt=where_v(f_right,fnew)
     filt2=where_v(f_right,phot_filters)
 
-    newMC=newMC[:,:,filt] #ordered columns. Cuts unnecessary columns    
+    newMC=_filter_major(iso,filt) #ordered filters, (filtri, masse, età). Cuts unnecessary columns
+    flux=_flux_grid(iso,filt) #come newMC, ma in flusso
     phot=phot[:,filt2] #ordered columns. Cuts unnecessary columns
     phot_err=phot_err[:,filt2] #ordered columns. Cuts unnecessary columns
 
-    wc=np.array([[2,0,1,5],[3,3,3,4]]) #(G-K), (G-J), (G-H), (Gbp-Grp)
-
-    if 'G2' in fnew:
-        qfl=flags['GAIA_DR2']['dr2_bp_rp_excess_factor_corr']
-        s1=0.004+8e-12*phot[:,3]**7.55
-        q1,=np.where(abs(qfl)>3*s1)
-    else:
-        qfl=flags['GAIA_EDR3']['edr3_bp_rp_excess_factor_corr']
-        s1=0.0059898+8.817481e-12*phot[:,3]**7.618399
-        q1,=np.where(abs(qfl)>3*s1) #excluded
-    if len(q1)>0:       
-        phot[q1,4]=np.nan
-        phot_err[q1,4]=np.nan
-        phot[q1,5]=np.nan
-        phot_err[q1,5]=np.nan
-
-    qfl=flags['2MASS']['qfl']
-    qJ=[]
-    qH=[]
-    qK=[]
-    for i in range(len(qfl)):
-        if qfl[i][0]!='A': qJ.append(i)
-        if qfl[i][1]!='A': qH.append(i)
-        if qfl[i][2]!='A': qK.append(i)
-    if len(qJ)>0:
-        qJ=np.array(qJ)
-        phot[qJ,0]=np.nan
-        phot_err[qJ,0]=np.nan
-    if len(qH)>0:
-        qH=np.array(qH)
-        phot[qH,1]=np.nan
-        phot_err[qH,1]=np.nan
-    if len(qK)>0:
-        qK=np.array(qK)
-        phot[qK,2]=np.nan
-        phot_err[qK,2]=np.nan
+    wc=np.array([[f_right.index(c[0]) for c in channels],[f_right.index(c[1]) for c in channels]]) #default: (G-K), (G-J), (G-H), (Gbp-Grp)
 
     red=np.zeros([xlen,ylen]) #reddening da applicare
-    if type(ebv)!=type(None):
-        for i in range(ylen): red[:,i]=extinction(ebv,f_right[i])
+    if type(preprocessed['ebv'])!=type(None):
+        for i in range(ylen): red[:,i]=_prep_extinction(preprocessed,f_right[i])
+
+    l=newMC.shape[1:] #(780,460) cioè masse ed età
 
-    l=newMC.shape #(780,460,10) cioè masse, età e filtri
-    sigma=100+np.zeros([l[0],l[1],ylen]) #matrice delle distanze fotometriche (780,460,3)
- 
     #calcolare reddening
-    m_cmsf=np.full(([xlen,4]),np.nan) #stime di massa (85,4)
-    a_cmsf=np.full(([xlen,4]),np.nan) #stime di età (85,4)
+    binary=len(iso)>4 #griglia con binarie (output di binary_grid)
+    if binary:
+        if posterior: raise ValueError('posterior=True is not compatible with a binary grid.')
+        q_cmsf=np.full(([xlen,n_ch]),np.nan) #stime del rapporto di massa
+    m_cmsf=np.full(([xlen,n_ch]),np.nan) #stime di massa (85,4)
+    a_cmsf=np.full(([xlen,n_ch]),np.nan) #stime di età (85,4)
 
-    n_val=np.zeros(4) #numero di stelle usate per la stima per canale (0) e tipologia (SRB ecc, 1) (4,1)
-    tofit=np.zeros([xlen,4]) #contiene, per ogni CMS, 1 se fittato, 0 se non fittato (4,2,1)
+    n_val=np.zeros(n_ch) #numero di stelle usate per la stima per canale (0) e tipologia (SRB ecc, 1) (4,1)
+    tofit=np.zeros([xlen,n_ch]) #contiene, per ogni CMS, 1 se fittato, 0 se non fittato (4,2,1)
 
     bin_corr=2.5*np.log10(2)*bin_frac #ossia, se le binarie sono identiche, la luminosità osservata è il doppio di quella della singola componente
     phot=phot-red+bin_corr #(6,2) come phot
@@ -608,49 +1386,152 @@ def isochronal_age(phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,surv
     #phot[where(WISE_W3_flag!='0'),col_W3]=np.nan
     #phot[where(WISE_W4_flag!='0'),col_W4]=np.nan
     
-    fate=np.ones([xlen,4]) #(4,85)  ci dice se la stella i nella stima j e nel canale k è stata fittata, ha errori alti, contaminazione ecc. Di default è contaminata (1)
-
-
-    sigma=np.full(([l[0],l[1],ylen]),np.nan) #(780,480,6) matrice delle distanze fotometriche
+    fate=np.ones([xlen,n_ch]) #(4,85)  ci dice se la stella i nella stima j e nel canale k è stata fittata, ha errori alti, contaminazione ecc. Di default è contaminata (1)
+
+
+    if kernel=='auto': kernel='numba' if _has_numba else 'numpy'
+    if kernel not in ['numba','numpy']: raise ValueError("Keyword 'kernel' must be one of: 'auto', 'numba', 'numpy'.")
+    if kernel=='numba' and _has_numba==False: raise ValueError("kernel='numba' requires the package numba.")
+    use_numba=kernel=='numba' and posterior==False and type(av_grid)==type(None) #_av_min usa i buffer del workspace
+
+    batched=type(batch_size)!=type(None)
+    if batched:
+        if search!='full' or type(mag_window)!=type(None) or posterior:
+            raise ValueError("batch_size is only available with search='full', mag_window=None and posterior=False.")
+        ws=_fit_workspace(l,0,0) #i chi quadro sono calcolati a blocchi, servono solo i buffer per _iso_crossing
+    elif use_numba: ws=_fit_workspace(l,0,0) #il kernel compilato non usa buffer intermedi
+    else: ws=_fit_workspace(l,ylen,n_ch) #buffer riutilizzati per ogni stella
+    sigma=ws['sigma'] #(6,780,480) matrice delle distanze fotometriche
+    cr=ws['cr'] #(4,780,480) #per il momento comprende le distanze in G-K, G-J, G-H, Gbp-Grp
+
+    if search=='pyramid':
+        if posterior: raise ValueError("posterior=True requires search='full'.")
+        pyr=isochrone_pyramid(iso,factor=pyramid_factor,n_levels=pyramid_levels)
+    elif search=='raster': #indice del punto di griglia più vicino, per ogni stella e canale (-1: fit esatto)
+        if posterior: raise ValueError("posterior=True requires search='full'.")
+        ras=np.full([xlen,n_ch],-1,dtype=np.int64)
+        for j in range(n_ch):
+            ras[:,j]=_raster_lookup(cmd_raster(iso,filt[wc[0,j]],filt[wc[1,j]],pixel=raster_pixel,tol=raster_tol),phot[:,wc[0,j]],phot[:,wc[1,j]])
+    elif search!='full': raise ValueError("Keyword 'search' must be either 'full', 'pyramid' or 'raster'.")
+    if type(mag_window)!=type(None) or search in ['raster','pyramid']:
+        if posterior: raise ValueError("posterior=True is not compatible with mag_window.")
+        mag_index=_mag_index(iso,filt)
+
+    if batched: #minimi di tutti i canali, calcolati per gruppi di stelle con gli stessi filtri validi
+        est_b=np.full([xlen,n_ch],np.inf)
+        ind_b=np.zeros([xlen,n_ch,2],dtype=int)
+        cross_b=np.full([3,xlen,n_ch],np.nan) #min(colth), max(colth), asb
+        code=_phot_bitmask(phot,phot_err,max_phot_err=ph_cut)
+        good=(code[:,None] >> np.arange(ylen)) & 1
+        ch_ok=(good[:,wc[0]]==1) & (good[:,wc[1]]==1) #canali con entrambi i filtri validi
+        wsb=_batch_workspace(l,ylen,batch_size)
+        for c in np.unique(code):
+            stars,=np.where(code==c)
+            jj,=np.where(ch_ok[stars[0]])
+            if len(jj)==0: continue
+            w,=np.where(good[stars[0]])
+            for b0 in range(0,len(stars),batch_size):
+                sb=stars[b0:b0+batch_size]
+                e_b=np.full([len(sb),ylen],np.nan)
+                for r in range(len(sb)): e_b[r,w]=-10.**(-0.4*phot_err[sb[r],w])+10.**(+0.4*phot_err[sb[r],w])
+                est,ind=_batch_min(flux,wc[:,jj],phot[sb],e_b,wsb)
+                est_b[sb[:,None],jj[None,:]]=est
+                ind_b[sb[:,None],jj[None,:]]=ind
+                for j in jj: cross_b[:,sb,j]=_batch_crossing(newMC[wc[0,j]],newMC[wc[1,j]],phot[sb,wc[0,j]],wsb)
+        del wsb
+
+    fit_av=type(av_grid)!=type(None)
+    if fit_av:
+        if type(ebv)!=type(None) or type(preprocessed['ebv'])!=type(None): raise ValueError('av_grid and ebv cannot be used together.')
+        if search!='full' or type(mag_window)!=type(None) or batched or posterior:
+            raise ValueError("av_grid is only available with search='full', mag_window=None, batch_size=None and posterior=False.")
+        av_grid=np.array(av_grid,dtype=float)
+        av_coef=np.array([extinction(1/3.16,f) for f in f_right]) #A_f/A_V
+        av_final=np.full(xlen,np.nan)
+
+    if posterior: #somma delle posterior marginali dei canali fittati
+        m_post=np.zeros([xlen,l[0]])
+        a_post=np.zeros([xlen,l[1]])
+        n_post=np.zeros(xlen)
     
     for i in range(xlen): #devo escludere poi i punti con errore fotometrico non valido     
         w,=np.where(is_phot_good(phot[i,:],phot_err[i,:],max_phot_err=ph_cut))
     #    print('valid',i,w)
         if len(w)==0: continue
         go=0
-        for j in range(4):
+        for j in range(n_ch):
             go+=isnumber(phot[i,wc[0,j]]+phot[i,wc[1,j]],finite=True)
         if go==0: continue
-        e_j=-10.**(-0.4*phot_err[i,w])+10.**(+0.4*phot_err[i,w])
-        for h in range(len(w)):
-    #        print(i,xlen,h,len(w),w[h],go,newMC[0,0,w[h]])
-            sigma[:,:,w[h]]=(10.**(-0.4*(newMC[:,:,w[h]]-phot[i,w[h]]))-1.)/e_j[h]
-        cr=np.zeros([l[0],l[1],4]) #(780,480,4) #per il momento comprende le distanze in G-K, G-J, G-H, Gbp-Grp
-        for j in range(4):
-            if isnumber(phot[i,wc[0,j]],finite=True)==0: continue
-            cr[:,:,j]=(sigma[:,:,wc[0,j]])**2+(sigma[:,:,wc[1,j]])**2 #equivale alla matrice delle distanze in (G,K), (G,J), (G,H), (Gbp,Grp)
-            colth=np.full(l[1],np.nan) #480 voglio verificare se la stella si trova "in mezzo" al set di isocrone oppure all'esterno; voglio fare un taglio a mag costante
-            asa=np.zeros(l[1])
-            for q in range(l[1]): #480
-       #         print(i,j,q,anew[q],phot[i,wc[0,j]],np.nanmin(newMC[:,q,wc[0,j]]))
-                asa[q],im0=min_v(newMC[:,q,wc[0,j]]-phot[i,wc[0,j]],absolute=True) #trova il punto teorico più vicino nel primo filtro per ogni isocrona
-                if abs(asa[q])<0.1: colth[q]=newMC[im0,q,wc[1,j]] #trova la magnitudine corrispondente nel secondo filtro della coppia
-            asb=min(asa,key=abs) #se la minima distanza nel primo filtro è maggiore della soglia, siamo al di fuori del range in massa delle isocrone
-       #     print(i,j,phot[i,wc[0,j]],phot_err[i,wc[0,j]],asb)
-       #     print(cr[:,:,j])
-            est,ind=min_v(cr[:,:,j])
-            if (est <= 2.25 or (phot[i,wc[1,j]] >= min(colth) and phot[i,wc[1,j]] <= max(colth))) and np.isnan(est)==False and (np.isnan(min(colth))==False and np.isnan(max(colth))==False):  #condizioni per buon fit: la stella entro griglia isocrone o a non più di 3 sigma, a condizione che esista almeno un'isocrona al taglio in "colth"
+        e_j=np.full(ylen,np.nan)
+        e_j[w]=-10.**(-0.4*phot_err[i,w])+10.**(+0.4*phot_err[i,w])
+        done=[] #filtri per cui sigma è già stata calcolata su tutta la griglia
+        if fit_av:
+            jj=[j for j in range(n_ch) if (wc[0,j] in w) and (wc[1,j] in w)]
+            if len(jj)==0: continue
+            av_i,est_av,ind_av=_av_min(flux,wc[:,jj],phot[i,:],e_j,av_coef,av_grid,ws,step=av_step)
+            phot[i,:]=phot[i,:]-av_coef*av_i #da qui in poi la stella è corretta per l'estinzione stimata
+        for j in range(n_ch):
+            k0,k1=wc[0,j],wc[1,j]
+            if isnumber(phot[i,k0],finite=True)==0: continue
+            if (k0 not in w) or (k1 not in w): continue #entrambi i filtri del canale devono essere validi
+            res=None
+            if batched:
+                if np.isinf(est_b[i,j]): continue #nessun punto valido della griglia
+                res=est_b[i,j],(ind_b[i,j,0],ind_b[i,j,1])
+            elif fit_av:
+                if np.isinf(est_av[jj.index(j)]): continue
+                res=est_av[jj.index(j)],tuple(ind_av[jj.index(j)])
+            if search=='pyramid':
+                res=_pyramid_min(pyr,flux,k0,k1,filt[k0],filt[k1],phot[i,k0],phot[i,k1],e_j[k0],e_j[k1])
+            elif search=='raster' and ras[i,j]>=0: #il chi quadro del punto del raster limita il minimo: basta cercarlo dove chi2<=est
+                ind=np.unravel_index(ras[i,j],l)
+                est=((flux[k0][ind]*10.**(0.4*phot[i,k0])-1.)/e_j[k0])**2+((flux[k1][ind]*10.**(0.4*phot[i,k1])-1.)/e_j[k1])**2
+                d0,d1=np.sqrt(est)*e_j[k0],np.sqrt(est)*e_j[k1]
+                if d0<1 and d1<1: res=_window_min(flux,mag_index,k0,k1,phot[i,k0],phot[i,k1],e_j[k0],e_j[k1],-2.5*np.log10(1-d0)+1e-6,-2.5*np.log10(1-d1)+1e-6,ws)
+            if type(res)==type(None) and type(mag_window)!=type(None):
+                res=_window_min(flux,mag_index,k0,k1,phot[i,k0],phot[i,k1],e_j[k0],e_j[k1],mag_window*phot_err[i,k0],mag_window*phot_err[i,k1],ws)
+            if type(res)==type(None) and use_numba:
+                est,i0,i1=_chi2_min_numba(flux[k0],flux[k1],10.**(0.4*phot[i,k0]),10.**(0.4*phot[i,k1]),e_j[k0],e_j[k1])
+                if np.isinf(est): continue #nessun punto valido della griglia
+                ind=(i0,i1)
+            elif type(res)==type(None): #ricerca completa (anche se la piramide o la finestra non trovano il minimo)
+                for k in [k0,k1]:
+                    if k not in done:
+                        _sigma_into(flux[k],phot[i,k],e_j[k],sigma[k])
+                        done.append(k)
+                _chi2_into(sigma[k0],sigma[k1],cr[j],ws['tmp']) #equivale alla matrice delle distanze nel canale j, es. (G,K)
+                est,ind=_argmin_inplace(cr[j],ws['mask'])
+                if np.isinf(est): continue #nessun punto valido della griglia
+            else: est,ind=res
+            if batched: c_min,c_max,asb=cross_b[:,i,j]
+            else:
+                r0,r1=0,l[0]
+                if type(mag_window)!=type(None) or search in ['raster','pyramid']: #solo le righe entro 0.1 mag dalla stella possono contenere il punto più vicino utile
+                    rows,=np.nonzero((mag_index['row_min'][k0]<=phot[i,k0]+0.1) & (mag_index['row_max'][k0]>=phot[i,k0]-0.1))
+                    if len(rows)>0: r0,r1=rows[0],rows[-1]+1
+                    else: r0,r1=0,1
+                colth,asa=_iso_crossing(newMC[k0,r0:r1],newMC[k1,r0:r1],phot[i,k0],ws=ws) #voglio verificare se la stella si trova "in mezzo" al set di isocrone oppure all'esterno; voglio fare un taglio a mag costante
+                asb=min(asa,key=abs) #se la minima distanza nel primo filtro è maggiore della soglia, siamo al di fuori del range in massa delle isocrone
+                c_min,c_max=min(colth),max(colth)
+            if (est <= 2.25 or (phot[i,wc[1,j]] >= c_min and phot[i,wc[1,j]] <= c_max)) and np.isnan(est)==False and (np.isnan(c_min)==False and np.isnan(c_max)==False):  #condizioni per buon fit: la stella entro griglia isocrone o a non più di 3 sigma, a condizione che esista almeno un'isocrona al taglio in "colth"
                 m_cmsf[i,j]=mnew[ind[0]] #massa del CMS i-esimo
                 a_cmsf[i,j]=anew[ind[1]] #età del CMS i-esimo
                 n_val[j]+=1
                 tofit[i,j]=1
+                if fit_av: av_final[i]=av_i
+                if binary: q_cmsf[i,j]=iso[4][ind[0]]
+                if posterior:
+                    m_pdf,a_pdf=grid_marginals(cr[j],mnew,anew)
+                    m_post[i,:]+=m_pdf
+                    a_post[i,:]+=a_pdf
+                    n_post[i]+=1
 
             if (is_phot_good(phot[i,wc[0,j]],phot_err[i,wc[0,j]],max_phot_err=ph_cut)==0) or (is_phot_good(phot[i,wc[1,j]],phot_err[i,wc[1,j]],max_phot_err=ph_cut)==0): pass #rimane 0
-            elif est > 2.25 and phot[i,wc[1,j]] < min(colth):  fate[i,j]=2
-            elif est > 2.25 and phot[i,wc[1,j]] > max(colth):  fate[i,j]=3
+            elif est > 2.25 and phot[i,wc[1,j]] < c_min:  fate[i,j]=2
+            elif est > 2.25 and phot[i,wc[1,j]] > c_max:  fate[i,j]=3
             elif est > 2.25 and abs(asb) >= 0.1: fate[i,j]=4
             else: fate[i,j]=5
-            if (border_age==True and est>=2.25 and phot[i,wc[1,j]]>max(colth)):
+            if (border_age==True and est>=2.25 and phot[i,wc[1,j]]>c_max):
                 a_cmsf[i,j]=anew[0]
                 tofit[i,j]=1
                 
@@ -682,14 +1563,194 @@ def isochronal_age(phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,surv
         ext=sample_name[i:] #estension
         sample_name=sample_name[:i]
         
-        f=open(os.path.join(path,str(sample_name+'_ages_'+model+'.txt')), "w+")
-        f.write(tabulate(np.column_stack((m_cmsf,a_cmsf,m_final,a_final)),
-                         headers=['G-K_MASS','G-J_MASS','G-H_MASS','Gbp-Grp_MASS','G-K_AGE','G-J_AGE','G-H_AGE','Gbp-Grp_AGE','MASS','AGE'], tablefmt='plain', stralign='right', numalign='right', floatfmt=".2f"))
-        f.close()
+        write_table(os.path.join(path,str(sample_name+'_ages_'+model)),np.column_stack((m_cmsf,a_cmsf,m_final,a_final)),
+                    [c+'_MASS' for c in ch_names]+[c+'_AGE' for c in ch_names]+['MASS','AGE'],out_format=out_format,floatfmt=".2f")
+
+    if posterior:
+        with np.errstate(invalid='ignore'):
+            m_post/=n_post[:,None] #stelle senza canali fittati -> NaN
+            a_post/=n_post[:,None]
+        post={'mass_percentiles':np.full([xlen,len(percentiles)],np.nan),
+              'age_percentiles':np.full([xlen,len(percentiles)],np.nan)}
+        for i in range(xlen):
+            post['mass_percentiles'][i,:]=pdf_percentiles(m_post[i,:],mnew,percentiles=percentiles)
+            post['age_percentiles'][i,:]=pdf_percentiles(a_post[i,:],anew,percentiles=percentiles)
+        if type(pdf_bins)!=type(None):
+            m_bins=np.linspace(mnew[0],mnew[-1],pdf_bins+1)
+            a_bins=np.exp(np.linspace(np.log(anew[0]),np.log(anew[-1]),pdf_bins+1))
+            im=np.clip(np.searchsorted(m_bins,mnew,side='right')-1,0,pdf_bins-1) #bin di ciascun punto di griglia
+            ia=np.clip(np.searchsorted(a_bins,anew,side='right')-1,0,pdf_bins-1)
+            post['mass_pdf']=np.zeros([xlen,pdf_bins])
+            post['age_pdf']=np.zeros([xlen,pdf_bins])
+            np.add.at(post['mass_pdf'].T,im,m_post.T)
+            np.add.at(post['age_pdf'].T,ia,a_post.T)
+            post['mass_bins']=m_bins
+            post['age_bins']=a_bins
+        return a_final,m_final,post
+
+    extra=[]
+    if fit_av: extra.append(av_final)
+    if binary:
+        with np.errstate(invalid='ignore'):
+            extra.append(np.nanmean(q_cmsf,axis=1))
+    if len(extra)>0: return (a_final,m_final)+tuple(extra)
 
     return a_final,m_final
 
 
+def star_chunks(phot,phot_err,par,par_err,flags,chunk_size=10000,start=0):
+    """
+    splits a sample of stars into consecutive chunks, to be fitted by isochronal_age_stream.
+    The inputs can be numpy arrays, memory-mapped arrays (np.load(..., mmap_mode='r'), np.memmap)
+    or h5py datasets: only one chunk at a time is read into memory.
+
+    input:
+        phot, phot_err, par, par_err, flags: as in isochronal_age
+        chunk_size (optional): number of stars per chunk. Default: 10000
+        start (optional): index of the first star to be returned. Default: 0
+
+    usage:
+        for phot1,phot_err1,par1,par_err1,flags1 in star_chunks(phot,phot_err,par,par_err,flags): ...
+    """
+    n=len(par)
+    for i0 in range(start,n,chunk_size):
+        i1=min(i0+chunk_size,n)
+        flags1={s:{k:np.asarray(flags[s][k][i0:i1]) for k in flags[s]} for s in flags}
+        yield np.asarray(phot[i0:i1]),np.asarray(phot_err[i0:i1]),np.asarray(par[i0:i1]),np.asarray(par_err[i0:i1]),flags1
+
+def isochronal_age_stream(chunks,phot_filters,iso,surveys,output,resume=True,**kwargs):
+    """
+    fits a sample of stars too large to be kept in memory, chunk by chunk, with isochronal_age.
+    The results of every chunk are appended to an HDF5 file, that also acts as a checkpoint:
+    if the run is interrupted, calling the function again with the same input resumes it
+    from the first star not yet written.
+
+    input:
+        chunks: an iterable yielding tuples (phot, phot_err, par, par_err, flags) in the same format as isochronal_age,
+            e.g. the output of star_chunks. Chunks can have any size, but must be returned in the same order in every run
+        phot_filters: names of the columns of phot
+        iso: a tuple containing the output of load_isochrones
+        surveys: list of surveys used
+        output: full path of the output HDF5 file
+        resume (optional): set to False to overwrite an existing output file instead of resuming from it. Default: True
+        any other keyword is passed to isochronal_age (apart from verbose and output).
+
+    usage:
+        n=isochronal_age_stream(star_chunks(phot,phot_err,par,par_err,flags),headers[0],iso,surveys,'ages.h5')
+        returns the number of stars in the output file. The file contains the datasets 'AGE' and 'MASS'
+        (one element per star) plus, if posterior=True, 'AGE_PERCENTILES' and 'MASS_PERCENTILES'
+        (and 'AGE_PDF', 'MASS_PDF', 'AGE_BINS', 'MASS_BINS' if pdf_bins is set), 'AV' if av_grid is set
+        and 'Q' if iso is a binary grid.
+        The attribute 'n_done' stores the number of stars already fitted.
+        Datasets can be read without loading them entirely, e.g. h5py.File('ages.h5','r')['AGE'][:1000].
+
+    notes:
+    isochronal_age is called once per chunk, so memory use depends on the chunk size, not on the sample size.
+    """
+
+    kwargs.pop('verbose',None)
+    kwargs.pop('output',None)
+    mode='a' if resume else 'w'
+    with h5py.File(output,mode) as f:
+        n_done=f.attrs.get('n_done',0)
+        n=0 #stelle lette finora dall'iteratore
+        for phot,phot_err,par,par_err,flags in chunks:
+            n1=len(par)
+            if n+n1<=n_done: #chunk già scritto
+                n+=n1
+                continue
+            i0=n_done-n #il chunk può essere stato interrotto a metà se i chunk hanno dimensione diversa
+            if i0>0:
+                phot,phot_err,par,par_err=phot[i0:],phot_err[i0:],par[i0:],par_err[i0:]
+                flags={s:{k:flags[s][k][i0:] for k in flags[s]} for s in flags}
+            res=isochronal_age(phot,phot_err,phot_filters,par,par_err,flags,iso,surveys,**kwargs)
+            data={'AGE':res[0],'MASS':res[1]}
+            if type(kwargs.get('av_grid'))!=type(None): data['AV']=res[2]
+            if len(iso)>4: data['Q']=res[-1]
+            elif len(res)==3 and 'AV' not in data:
+                for k in res[2]:
+                    if k.endswith('_bins'):
+                        if k.upper() not in f: f.create_dataset(k.upper(),data=res[2][k])
+                    else: data[k.upper()]=res[2][k]
+            for k in data:
+                if k not in f: f.create_dataset(k,shape=(0,)+data[k].shape[1:],maxshape=(None,)+data[k].shape[1:],dtype='f8',chunks=True)
+                f[k].resize(n_done+len(data[k]),axis=0)
+                f[k][n_done:]=data[k]
+            n_done+=len(res[0])
+            n+=n1
+            f.attrs['n_done']=n_done #checkpoint: scritto solo dopo i dati
+            f.flush()
+    return n_done
+
+
+def isochronal_age_ensemble(phot_app,phot_err_app,phot_filters,par,par_err,flags,isos,surveys,model_names=None,ebv=None,n_jobs=None,verbose=False,output=None,out_format='csv',**kwargs):
+    """
+    estimates ages and masses of a sample of stars with several isochrone grids (e.g. different models).
+    The photometry is converted to absolute magnitudes and cleaned by the quality cuts only once (see preprocess_phot);
+    the fits against the different grids are then run in parallel threads.
+
+    input:
+        phot_app, phot_err_app, phot_filters, par, par_err, flags, surveys: as in isochronal_age
+        isos: list of tuples, each one containing the output of load_isochrones
+        model_names (optional): list of names of the models, used as labels. Default: None (=['model_0','model_1',...])
+        ebv (optional): color excess E(B-V) of the sources. Default: None (=no extinction correction)
+        n_jobs (optional): maximum number of grids fitted at the same time. Each thread needs its own fitting workspace,
+            about (no. of filters+no. of channels+2)*(no. of grid points)*8 bytes. Default: None (=len(isos))
+        verbose (optional): set to True to write the results to a file. Default: False
+        output (mandatory if verbose=True): full path of the input file, used to name the output file
+        out_format (optional): format of the output file (see write_table). Default: 'csv'
+        any other keyword is passed to isochronal_age.
+
+    usage:
+        ages,masses,summary=isochronal_age_ensemble(phot,phot_err,headers[0],par,par_err,flags,[iso1,iso2],surveys,model_names=['bt_settl','mist'])
+        returns ages and masses as 2D arrays (no. of stars, no. of models) and a dictionary 'summary' with keys
+        'models' and, for both 'age' and 'mass', the mean, median, standard deviation, minimum and maximum across models
+        (e.g. 'age_median') and the number of models with a valid estimate ('age_n', 'mass_n').
+        If posterior=True, summary['posterior'] is the list of the posterior dictionaries of the models;
+        if av_grid is set, summary['av'] contains the best-fit A_V (no. of stars, no. of models), and if any grid
+        is a binary grid, summary['q'] the mass ratios (NaN for single-star grids).
+        If verbose=True, a file sample_name_ages_ensemble.csv (or other extension, see out_format) is created in the folder of "output".
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if type(model_names)==type(None): model_names=['model_'+str(k) for k in range(len(isos))]
+    if len(model_names)!=len(isos): raise ValueError('model_names must have the same length as isos.')
+    kwargs.pop('preprocessed',None)
+    prep=preprocess_phot(phot_app,phot_err_app,phot_filters,par,par_err,flags,ebv=ebv,quality_mask=kwargs.pop('quality_mask',None))
+
+    def fit(iso): #i thread condividono prep: l'estinzione di un filtro può essere calcolata due volte, ma con lo stesso risultato
+        return isochronal_age(phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,surveys,preprocessed=prep,**kwargs)
+
+    n_jobs=len(isos) if type(n_jobs)==type(None) else n_jobs
+    with ThreadPoolExecutor(max_workers=max(1,n_jobs)) as executor: #numpy rilascia il GIL nelle operazioni sulle griglie
+        res=list(executor.map(fit,isos))
+
+    ages=np.column_stack([r[0] for r in res])
+    masses=np.column_stack([r[1] for r in res])
+    summary={'models':list(model_names)}
+    with np.errstate(invalid='ignore'):
+        for name,x in [['age',ages],['mass',masses]]:
+            n=np.sum(np.isnan(x)==False,axis=1)
+            full=np.where(n>0)[0] #evita i warning di nanmean ecc. per stelle senza stime
+            for stat,fun in [['mean',np.nanmean],['median',np.nanmedian],['std',np.nanstd],['min',np.nanmin],['max',np.nanmax]]:
+                summary[name+'_'+stat]=np.full(len(x),np.nan)
+                if len(full)>0: summary[name+'_'+stat][full]=fun(x[full],axis=1)
+            summary[name+'_n']=n
+    if type(kwargs.get('av_grid'))!=type(None): summary['av']=np.column_stack([r[2] for r in res])
+    elif kwargs.get('posterior',False): summary['posterior']=[r[2] for r in res]
+    if any([len(iso)>4 for iso in isos]): summary['q']=np.column_stack([r[-1] if len(iso)>4 else np.full(len(r[0]),np.nan) for r,iso in zip(res,isos)])
+
+    if verbose==True:
+        path=os.path.dirname(output)
+        sample_name=os.path.splitext(os.path.split(output)[1])[0]
+        write_table(os.path.join(path,str(sample_name+'_ages_ensemble')),
+                    np.column_stack((masses,ages,summary['mass_median'],summary['age_median'],summary['age_min'],summary['age_max'])),
+                    [m+'_MASS' for m in model_names]+[m+'_AGE' for m in model_names]+['MASS','AGE','AGE_MIN','AGE_MAX'],
+                    out_format=out_format,floatfmt=".2f")
+
+    return ages,masses,summary
+
+
 def extinction(ebv,col):
     """
     computes extinction/color excess in a filter "col", given a certain E(B-V) "ebv",
@@ -795,7 +1856,343 @@ def complement_v(arr,n):
     compl,=np.where(compl==True)
     return compl
 
-def search_phot(filename,surveys,coordinates='equatorial',verbose=False,overwrite=False,merge=False):
+def _survey_radec(survey):
+    #colonne di posizione (J2000) restituite da XMatch per ciascuna survey
+    if survey=='GAIA_EDR3':
+        ra_name='ra_epoch2000'
+        dec_name='dec_epoch2000'
+    elif survey=='GAIA_DR2':
+        ra_name='ra_epoch2000'
+        dec_name='dec_epoch2000'
+    elif survey=='2MASS':
+        ra_name='RAJ2000'
+        dec_name='DEJ2000'
+    if survey=='ALLWISE':
+        ra_name='RAJ2000'
+        dec_name='DEJ2000'
+    if survey=='WISE':
+        ra_name='ra'
+        dec_name='dec'        
+    return ra_name,dec_name
+
+def _survey_properties(survey):
+    #codice XMatch, colonne, intestazioni, formati, filtri e flag di qualità di ciascuna survey
+    if survey=='GAIA_EDR3':
+        code='vizier:I/350/gaiaedr3'
+        col1=['source_id','ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','ruwe','phot_g_mean_mag','phot_g_mean_mag_error','phot_bp_mean_mag','phot_bp_mean_mag_error','phot_rp_mean_mag','phot_rp_mean_mag_error','dr2_radial_velocity','dr2_radial_velocity_error','phot_bp_rp_excess_factor_corrected'] #last from Riello et al. 2020
+        hea=['source_id','ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','ruwe','G','G_err','Gbp','Gbp_err','Grp','Grp_err','radial_velocity', 'radial_velocity_error','edr3_bp_rp_excess_factor_corr']
+        fmt=(".5f",".11f",".4f",".11f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".3f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f")
+        f_list=['G','Gbp','Grp']
+        q_flags=['ruwe','edr3_bp_rp_excess_factor_corr']
+        fill_value=np.nan
+    elif survey=='2MASS':
+        code='vizier:II/246/out'
+        col1=['2MASS','RA','DEC','Jmag','e_Jmag','Hmag','e_Hmag','Kmag','e_Kmag','Qfl']
+        hea=['ID','ra','dec','J','J_err','H','H_err','K','K_err','qfl']
+        fmt=(".5f",".8f",".8f",".3f",".3f",".3f",".3f",".3f",".3f")
+        f_list=['J','H','K']
+        q_flags=['qfl']
+        fill_value='ZZZ'
+    elif survey=='ALLWISE':
+        code='vizier:II/328/allwise'
+        col1=['AllWISE','RAJ2000','DEJ2000','W1mag','e_W1mag','W2mag','e_W2mag','W3mag','e_W3mag','W4mag','e_W4mag','ccf','d2M']
+        hea=['ID','ra','dec','W1','W1_err','W2','W2_err','W3','W3_err','W4','W4_err','ccf','d2M']
+        fmt=(".5f",".8f",".8f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".4f")
+        f_list=['W1','W2','W3','W4']
+        q_flags=['ccf']
+        fill_value='ZZZZ'
+    elif survey=='GAIA_DR2':
+        code='vizier:I/345/gaia2'
+        col1=['source_id','ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','phot_g_mean_flux','phot_g_mean_flux_error','phot_g_mean_mag','phot_bp_mean_flux','phot_bp_mean_flux_error','phot_bp_mean_mag','phot_rp_mean_flux','phot_rp_mean_flux_error','phot_rp_mean_mag','radial_velocity','radial_velocity_error','phot_bp_rp_excess_factor','phot_bp_rp_excess_factor_corrected']
+        hea=['source_id','ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','G2_flux','G2_flux_err','G2','Gbp2_flux','Gbp2_flux_err','Gbp2','Grp2_flux','Grp2_flux_err','Grp2','radial_velocity','radial_velocity_error','dr2_bp_rp_excess_factor','dr2_bp_rp_excess_factor_corr']
+        fmt=(".5f",".11f",".4f",".11f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f")
+        f_list=['G2','Gbp2','Grp2']            
+        q_flags=['dr2_bp_rp_excess_factor','dr2_bp_rp_excess_factor_corr']
+        fill_value=np.nan
+    elif survey=='WISE':
+        code='vizier:II/311/wise'
+        col1=['JNAME','ra','dec','W1mag','e_W1mag','W2mag','e_W2mag','W3mag','e_W3mag','W4mag','e_W4mag','cc_flags']
+        hea=['ID','ra','dec','W1_w','W1_w_err','W2_w','W2_w_err','W3_w','W3_w_err','W4_w','W4_w_err','ccf_w']
+        fmt=(".5f",".8f",".8f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".3f")
+        f_list=['W1_w','W2_w','W3_w','W4_w']
+        q_flags=['ccf_w']
+        fill_value='ZZZZ'
+
+    return code,col1,hea,fmt,f_list,q_flags,fill_value
+
+def _query_cols(survey):
+    #colonne richieste a XMatch: quelle di col1 (senza le colonne calcolate dopo la query e senza RA, DEC dell'input) e le coordinate
+    col1=_survey_properties(survey)[1]
+    derived=['phot_bp_rp_excess_factor','phot_bp_rp_excess_factor_corrected'] if survey=='GAIA_DR2' else []
+    cols=[x for x in col1 if x not in derived and x not in ['RA','DEC']]
+    cols.extend([x for x in _survey_radec(survey) if x not in cols])
+    return cols
+
+_tile_ext={'hdf5':'.h5','parquet':'.parquet'}
+
+def _tile_pixels(ra,dec,nside):
+    #pixel HEALPix (nested) che contengono le coordinate, più gli 8 vicini: il raggio di match è molto più piccolo di un tile
+    hp=HEALPix(nside=nside,order='nested',frame=ICRS())
+    pix=hp.lonlat_to_healpix(ra*u.deg,dec*u.deg)
+    nb=hp.neighbours(pix)
+    return np.unique(np.concatenate((pix,nb[nb>=0])))
+
+def write_tiles(data,path,survey,nside=32,out_format='hdf5'):
+    """
+    splits a local extract of a survey catalogue into HEALPix tiles, to be read by local_xmatch
+    (and by search_phot through the keyword catalogue_path).
+
+    input:
+        data: an astropy Table with the columns of the survey, as returned by XMatch: the columns
+            listed in search_phot for that survey plus the J2000 position columns
+            (ra_epoch2000/dec_epoch2000 for Gaia, RAJ2000/DEJ2000 for 2MASS and ALLWISE, ra/dec for WISE)
+        path: root directory of the local catalogues. Tiles are written in path/survey/
+        survey: name of the survey, e.g. 'GAIA_EDR3'
+        nside (optional): HEALPix nside of the tiles (nested ordering). Default: 32 (tiles of about 1.8 deg)
+        out_format (optional): 'hdf5' or 'parquet' (requires pyarrow). Default: 'hdf5'
+
+    usage:
+        t=Table.read('edr3_extract.fits')
+        write_tiles(t,'/data/catalogues','GAIA_EDR3')
+        writes the files /data/catalogues/GAIA_EDR3/<pixel>.h5 and the index /data/catalogues/GAIA_EDR3/index.pkl
+
+    notes:
+    requires astropy_healpix. Existing tiles of the same survey are overwritten.
+    """
+    if _has_healpix==False: raise ValueError('write_tiles requires astropy_healpix.')
+    if out_format not in _tile_ext: raise ValueError("Keyword 'out_format' must be one of: "+', '.join(_tile_ext))
+    survey=survey.upper()
+    ra_name,dec_name=_survey_radec(survey)
+    hp=HEALPix(nside=nside,order='nested',frame=ICRS())
+    pix=hp.lonlat_to_healpix(np.array(data[ra_name])*u.deg,np.array(data[dec_name])*u.deg)
+    s_path=os.path.join(path,survey)
+    os.makedirs(s_path,exist_ok=True)
+    pixels=np.unique(pix)
+    for p in pixels:
+        file=os.path.join(s_path,str(p)+_tile_ext[out_format])
+        if out_format=='hdf5': data[pix==p].write(file,format='hdf5',path='data',serialize_meta=True,overwrite=True)
+        else: data[pix==p].write(file,format='parquet',overwrite=True)
+    with open(os.path.join(s_path,'index.pkl'),'wb') as f:
+        pickle.dump({'nside':nside,'format':out_format,'pixels':pixels},f)
+    return pixels
+
+def local_xmatch(cat1,survey,path,max_distance=1.3*u.arcsec,colRA1='RA',colDec1='DEC'):
+    """
+    positional cross-match of a list of coordinates against a local copy of a survey catalogue,
+    split in HEALPix tiles by write_tiles. It replaces XMatch.query when CDS cannot be reached.
+
+    input:
+        cat1: an astropy Table with the input coordinates (deg)
+        survey: name of the survey, e.g. 'GAIA_EDR3'
+        path: root directory of the local catalogues (see write_tiles)
+        max_distance (optional): maximum angular distance. Default: 1.3 arcsec
+        colRA1, colDec1 (optional): names of the coordinate columns of cat1. Default: 'RA', 'DEC'
+
+    usage:
+        data=local_xmatch(coo_table,'2MASS','/data/catalogues')
+        returns a Table with the same structure as XMatch.query(cat1=coo_table,cat2='vizier:II/246/out',...):
+        one row for every pair within max_distance, with the columns 'angDist' (arcsec),
+        the columns of cat1 and those of the catalogue.
+
+    notes:
+    only the tiles around the input stars are read. If astropy_healpix is not installed,
+    all the tiles of the survey are read.
+    If a column of the catalogue has the same name of one of cat1, the latter is kept.
+    """
+    survey=survey.upper()
+    s_path=os.path.join(path,survey)
+    index_file=os.path.join(s_path,'index.pkl')
+    if file_search(index_file)==0: raise ValueError('No local catalogue found for survey '+survey+' in '+str(path))
+    with open(index_file,'rb') as f:
+        index=pickle.load(f)
+    ra1=np.array(cat1[colRA1],dtype=float)
+    dec1=np.array(cat1[colDec1],dtype=float)
+    ok,=np.where(np.isfinite(ra1) & np.isfinite(dec1))
+    pixels=index['pixels']
+    if _has_healpix and len(ok)>0: pixels=np.intersect1d(pixels,_tile_pixels(ra1[ok],dec1[ok],index['nside']))
+    fmt=index['format']
+    files=[os.path.join(s_path,str(p)+_tile_ext[fmt]) for p in pixels]
+    if len(files)==0: files=[os.path.join(s_path,str(index['pixels'][0])+_tile_ext[fmt])] #nessun tile utile: serve solo la struttura
+    if fmt=='hdf5': tiles=[Table.read(file,format='hdf5',path='data') for file in files]
+    else: tiles=[Table.read(file,format='parquet') for file in files]
+    cat2=vstack(tiles) if len(tiles)>1 else tiles[0]
+    if len(pixels)==0: cat2=cat2[:0]
+    ra_name,dec_name=_survey_radec(survey)
+    if len(ok)>0 and len(cat2)>0:
+        c1=SkyCoord(ra=ra1[ok]*u.deg,dec=dec1[ok]*u.deg)
+        c2=SkyCoord(ra=np.array(cat2[ra_name],dtype=float)*u.deg,dec=np.array(cat2[dec_name],dtype=float)*u.deg)
+        i1,i2,d2d,_=search_around_sky(c1,c2,max_distance)
+        w=np.lexsort((d2d.arcsec,i1))
+        i1=ok[i1[w]]
+        i2=i2[w]
+        dist=d2d.arcsec[w]
+    else:
+        i1=np.zeros(0,dtype=int)
+        i2=np.zeros(0,dtype=int)
+        dist=np.zeros(0)
+    res=Table()
+    res['angDist']=dist
+    for col in cat1.colnames: res[col]=cat1[col][i1]
+    for col in cat2.colnames:
+        if col not in cat1.colnames: res[col]=cat2[col][i2]
+    return res
+
+def _vizier_resolve(name):
+    #cerca la stella nel catalogo di Gaia EDR3 (Simbad a volte non trova gli ID di Gaia)
+    x=Vizier.query_object(name,catalog='I/350/gaiaedr3',radius=1*u.arcsec)
+    if len(x)==0: return np.nan,np.nan
+    t=x[0]
+    c=0
+    if len(t)>1:
+        c=[k for k in range(len(t)) if str(t['Source'][k]) in name] #l'ID di Gaia nel nome, se presente, sceglie la sorgente
+        c=c[0] if len(c)>0 else np.argmin(t['Gmag'])
+    return float(t['RAJ2000'][c]),float(t['DEJ2000'][c])
+
+def resolve_names(names,cache=None,batch_size=500):
+    """
+    returns the equatorial coordinates (J2000, deg) of a list of star names.
+    Names are sent to Simbad in batches (one query for batch_size names);
+    those not found by Simbad are searched one by one in Gaia EDR3 on Vizier.
+    Resolved names are stored in a SQLite database, so that they are not queried again.
+
+    input:
+        names: a list or array of star names
+        cache (optional): full path of the SQLite database used as cache. If it does not exist, it is created.
+            Default: None (=no cache)
+        batch_size (optional): maximum number of names per Simbad query. Default: 500
+
+    usage:
+        coo=resolve_names(['HIP 1113','HIP 1993'],cache='/path/star_names.sqlite')
+        returns an array (no. of names, 2) with ra and dec of the stars. Rows of unresolved stars are NaN.
+
+    notes:
+    only resolved names are stored in the cache: unresolved names are searched again at every call.
+    """
+    names=[str(x).strip() for x in names]
+    n=len(names)
+    coo=np.full([n,2],np.nan)
+    found={}
+    if type(cache)!=type(None):
+        db=sqlite3.connect(str(cache))
+        db.execute('CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, ra REAL, dec REAL)')
+        uniq=list(set(names))
+        for i in range(0,len(uniq),batch_size): #limite al numero di parametri di una query SQLite
+            chunk=uniq[i:i+batch_size]
+            rows=db.execute('SELECT name, ra, dec FROM names WHERE name IN ('+','.join(['?']*len(chunk))+')',chunk).fetchall()
+            for r in rows: found[r[0]]=(r[1],r[2])
+    missing=[x for x in dict.fromkeys(names) if x not in found]
+    new={}
+    for i in range(0,len(missing),batch_size):
+        chunk=missing[i:i+batch_size]
+        x=Simbad.query_objects(chunk)
+        if type(x)==type(None): continue
+        for j in range(len(x)):
+            if len(str(x['RA'][j]).split(' '))<3: continue #oggetto senza coordinate
+            k=int(x['SCRIPT_NUMBER_ID'][j])-1
+            new[chunk[k]]=(Angle(ang_deg(str(x['RA'][j]))).degree,Angle(ang_deg(str(x['DEC'][j]),form='dms')).degree)
+    for name in missing:
+        if name not in new:
+            radec=_vizier_resolve(name) #tries alternative resolver
+            if np.isfinite(radec[0]): new[name]=radec
+    found.update(new)
+    if type(cache)!=type(None):
+        with db:
+            db.executemany('INSERT OR REPLACE INTO names VALUES (?,?,?)',[(k,new[k][0],new[k][1]) for k in new])
+        db.close()
+    for i in range(n):
+        if names[i] in found: coo[i]=found[names[i]]
+    return coo
+
+def _coo_keys(coo):
+    #chiave (SHA-1) di ciascuna coppia di coordinate, usata dalla cache delle query di search_phot
+    coo=np.ascontiguousarray(coo,dtype=float)
+    return np.array([hashlib.sha1(c.tobytes()).hexdigest() for c in coo])
+
+def _survey_cache(path,survey,keys=None,data=None):
+    """
+    reads (if keys is None) or writes the query cache of a survey used by search_phot: the file path/survey.pkl
+    contains the set of the coordinate keys (_coo_keys) already queried and a Table with all the rows returned by
+    the queries, with their key in the column '_key'. Stars without counterparts only appear in the set.
+    """
+    file=os.path.join(path,survey+'.pkl')
+    if type(keys)==type(None):
+        if file_search(file)==0: return set(),None
+        with open(file,'rb') as f:
+            keys=pickle.load(f)
+            data=pickle.load(f)
+        return keys,data
+    with open(file+'.tmp','wb') as f:
+        pickle.dump(keys,f)
+        pickle.dump(data,f)
+    os.replace(file+'.tmp',file)
+
+def read_coordinates(filename,chunk_size=None):
+    """
+    reads a coordinate file for search_phot: a 2-column text file (comma-separated if its extension is .csv,
+    whitespace-separated otherwise) or a binary .npy file with a (no. of stars, 2) array.
+
+    input:
+        filename: full path of the file
+        chunk_size (optional): if set, the file is read in pieces of chunk_size rows. Default: None
+
+    usage:
+        coo=read_coordinates('/path/stars.txt')
+        returns an array (no. of stars, 2) of floats, like np.genfromtxt(filename) (lines beginning with '#' are skipped,
+        values that are not numbers are NaN).
+        for coo in read_coordinates('/path/stars.csv',chunk_size=10**6): ...
+        iterates over arrays of (at most) 10**6 rows.
+
+    notes:
+    text files are read by pandas (with the multi-threaded pyarrow engine, if installed, for .csv files).
+    .npy files are opened as memory maps: nothing is read until the rows are used.
+    """
+    ext=os.path.splitext(str(filename))[1]
+    if ext=='.npy':
+        coo=np.load(filename,mmap_mode='r')
+        if type(chunk_size)==type(None): return coo
+        return (coo[i:i+chunk_size] for i in range(0,len(coo),chunk_size))
+    skip=0
+    with open(filename) as f: #intestazione (righe che iniziano con '#')
+        for line in f:
+            if line.lstrip().startswith('#')==False: break
+            skip+=1
+    if ext=='.csv' and _has_pyarrow and type(chunk_size)==type(None):
+        tab=pd.read_csv(filename,sep=',',header=None,skiprows=skip,usecols=[0,1],engine='pyarrow')
+    elif ext=='.csv': tab=pd.read_csv(filename,sep=',',header=None,skiprows=skip,usecols=[0,1],comment='#',engine='c',float_precision='round_trip',chunksize=chunk_size)
+    else: tab=pd.read_csv(filename,sep=r'\s+',header=None,skiprows=skip,usecols=[0,1],comment='#',engine='c',float_precision='round_trip',chunksize=chunk_size)
+
+    def number(x):
+        try: return float(x)
+        except (ValueError,TypeError): return np.nan
+
+    def to_array(t):
+        #valori non numerici (ad esempio i nomi delle colonne) diventano NaN, come in np.genfromtxt
+        return np.column_stack([t[k].to_numpy(dtype=float) if pd.api.types.is_numeric_dtype(t[k]) else np.array([number(x) for x in t[k]]) for k in t.columns])
+    if type(chunk_size)==type(None): return to_array(tab)
+    return (to_array(t) for t in tab)
+
+def read_names(filename):
+    """
+    reads a list of star names for search_phot: one name per line, or the column 'Name' if the extension is .csv.
+    Text after '#' and empty lines are ignored.
+
+    usage:
+        names=read_names('/path/target_list.txt')
+        returns a numpy array of strings.
+    """
+    if os.path.splitext(str(filename))[1]=='.csv':
+        engine='pyarrow' if _has_pyarrow else 'c'
+        if engine=='pyarrow': tab=pd.read_csv(filename,sep=',',header=0,usecols=['Name'],engine=engine)
+        else: tab=pd.read_csv(filename,sep=',',header=0,comment='#',usecols=['Name'],engine=engine)
+        return tab['Name'].to_numpy().astype(str)
+    names=[]
+    with open(filename) as f:
+        for line in f:
+            line=line.split('#')[0].strip()
+            if line!='': names.append(line)
+    return np.array(names)
+
+def search_phot(filename,surveys,coordinates='equatorial',verbose=False,overwrite=False,merge=False,out_format='csv',catalogue_path=None,n_jobs=None,chunk_size=None,max_retries=3,retry_wait=1.,name_cache=None,batch=False,query_cache=None):
     """
     given a file of coordinates or star names and a list of surveys, returns
     a dictionary with astrometry, kinematics and photometry retrieved from the catalogs
@@ -809,14 +2206,31 @@ def search_phot(filename,surveys,coordinates='equatorial',verbose=False,overwrit
             the same applies if 'galactic', but with rows indicating (l, b)
             if False, it is a list of star names. Default: 'equatorial'
         verbose: set to True to create output files with the retrieved coordinates and data. Default: False
-        overwrite: set to True to ignore previous queries done with the same input file. Default: False (=load already present data)
+        overwrite: set to True to query again all the stars, ignoring (and then updating) the results of previous queries.
+            Default: False (=only stars missing from query_cache are queried)
         merge: set to 'WISE' to merge ALLWISE and WISE catalogues. If a star is present in both releases, the ALLWISE entry is preferred.
             Default: False.
+        out_format: format of the output files if verbose=True: 'csv', 'fits', 'hdf5', 'parquet' or 'txt' (see write_table).
+            Default: 'csv'
+        catalogue_path: root directory of local HEALPix-tiled copies of the catalogues (see write_tiles).
+            If set, the cross-match is done locally through local_xmatch instead of querying XMatch. Default: None
+        n_jobs: maximum number of queries (surveys, or chunks of them: see chunk_size) run at the same time.
+            Default: None (=as many as the surveys). Set n_jobs=1 to run them one after the other.
+        chunk_size: maximum number of stars uploaded to XMatch in a single query. Default: None (=the whole list).
+            Large inputs should be split, because XMatch limits the size of uploaded tables.
+        max_retries: number of times a failed query is repeated before giving up. Default: 3
+        retry_wait: waiting time (s) before the first retry, doubled at every further attempt. Default: 1
+        name_cache: only used if coordinates=False. Full path of the SQLite database where resolved star names are stored (see resolve_names).
+            Default: None (=file 'star_names.sqlite' in the folder of the input file)
+        batch: only used if coordinates=False. If True, unresolved stars never stop the program: their rows are filled with NaNs
+            and the user is not asked whether to continue, e.g. in cluster jobs. Default: False
+        query_cache: folder where the results of the queries are stored, one file per survey (see notes).
+            Default: None (=folder 'query_cache' in the folder of the input file)
 
     usage:
         search_phot(filename,['GAIA_EDR3','2MASS','ALLWISE'],coordinates=False,verbose=True)
         will search for all the stars in the input file and return the results both as a Table object
-        and as .txt files, each named filename+'_ithSURVEYNAME.txt'.
+        and as files (.csv by default, see out_format), each named filename+'_ithSURVEYNAME'.
         search_phot(filename,['GAIA_EDR3','2MASS','ALLWISE'],coordinates=False,verbose=False)
         will not create any file.
         
@@ -827,87 +2241,35 @@ def search_phot(filename,surveys,coordinates='equatorial',verbose=False,overwrit
             or this:
             #coordinate system: 'galactic'
             Coordinates are interpreted as J2000: be careful to it.
+            The file can also be a binary .npy file with a (no. of stars, 2) array, which is read as a memory map (see read_coordinates).
             This mode is faster, but might include some field stars.
         if coordinates=False:
             the input file must not have a header, and simply be a list of stars.
-            This mode is slower, because every star will be searched for individually in Simbad and,
-            if not found, tries on Vizier (sometimes Simbad does not find Gaia IDs).
+            This mode is slower, because star names must be resolved: they are searched for in Simbad
+            (with one query for up to 500 stars) and, if not found, on Vizier (sometimes Simbad does not find Gaia IDs).
+            Resolved names are stored in name_cache, so they are not searched for again in later runs.
             An alert is raised if some stars are missing, and the resulting row are filled with NaNs.
+            Missing stars are listed in the file sample_name+'_unresolved' (row of the input file, name; format given by out_format).
+            Unless batch=True, the user is asked whether to end the program.
             The returned coordinate array has the same length as the input file,
             while the output Tables might not.
+        The results of the queries are stored in query_cache, separately for each survey and each star (identified by
+        its coordinates, not by the name of the input file). A new call only queries the stars (and the surveys)
+        not yet present in the cache, and reuses the others: renaming the input file, adding stars or surveys
+        does not require to repeat all the queries, while stars whose coordinates have changed are queried again.
+        Only the columns used by search_phot are requested to XMatch and stored in the cache.
+        Every chunk of every survey is saved in the folder filename+'_SURVEYS_chunks' as soon as it has been retrieved,
+        and the folder is deleted at the end. If the program is stopped (e.g. by a network failure), running it again
+        with overwrite=False only queries the missing chunks.
     """
+    from concurrent.futures import ThreadPoolExecutor
    
-    def survey_properties(survey):
-        if survey=='GAIA_EDR3':
-            code='vizier:I/350/gaiaedr3'
-            col1=['source_id','ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','ruwe','phot_g_mean_mag','phot_g_mean_mag_error','phot_bp_mean_mag','phot_bp_mean_mag_error','phot_rp_mean_mag','phot_rp_mean_mag_error','dr2_radial_velocity','dr2_radial_velocity_error','phot_bp_rp_excess_factor_corrected'] #last from Riello et al. 2020
-            hea=['source_id','ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','ruwe','G','G_err','Gbp','Gbp_err','Grp','Grp_err','radial_velocity', 'radial_velocity_error','edr3_bp_rp_excess_factor_corr']
-            fmt=(".5f",".11f",".4f",".11f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".3f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f")
-            f_list=['G','Gbp','Grp']
-            q_flags=['ruwe','edr3_bp_rp_excess_factor_corr']
-            fill_value=np.nan
-        elif survey=='2MASS':
-            code='vizier:II/246/out'
-            col1=['2MASS','RA','DEC','Jmag','e_Jmag','Hmag','e_Hmag','Kmag','e_Kmag','Qfl']
-            hea=['ID','ra','dec','J','J_err','H','H_err','K','K_err','qfl']
-            fmt=(".5f",".8f",".8f",".3f",".3f",".3f",".3f",".3f",".3f")
-            f_list=['J','H','K']
-            q_flags=['qfl']
-            fill_value='ZZZ'
-        elif survey=='ALLWISE':
-            code='vizier:II/328/allwise'
-            col1=['AllWISE','RAJ2000','DEJ2000','W1mag','e_W1mag','W2mag','e_W2mag','W3mag','e_W3mag','W4mag','e_W4mag','ccf','d2M']
-            hea=['ID','ra','dec','W1','W1_err','W2','W2_err','W3','W3_err','W4','W4_err','ccf','d2M']
-            fmt=(".5f",".8f",".8f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".4f")
-            f_list=['W1','W2','W3','W4']
-            q_flags=['ccf']
-            fill_value='ZZZZ'
-        elif survey=='GAIA_DR2':
-            code='vizier:I/345/gaia2'
-            col1=['source_id','ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','phot_g_mean_flux','phot_g_mean_flux_error','phot_g_mean_mag','phot_bp_mean_flux','phot_bp_mean_flux_error','phot_bp_mean_mag','phot_rp_mean_flux','phot_rp_mean_flux_error','phot_rp_mean_mag','radial_velocity','radial_velocity_error','phot_bp_rp_excess_factor','phot_bp_rp_excess_factor_corrected']
-            hea=['source_id','ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','G2_flux','G2_flux_err','G2','Gbp2_flux','Gbp2_flux_err','Gbp2','Grp2_flux','Grp2_flux_err','Grp2','radial_velocity','radial_velocity_error','dr2_bp_rp_excess_factor','dr2_bp_rp_excess_factor_corr']
-            fmt=(".5f",".11f",".4f",".11f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f",".4f")
-            f_list=['G2','Gbp2','Grp2']            
-            q_flags=['dr2_bp_rp_excess_factor','dr2_bp_rp_excess_factor_corr']
-            fill_value=np.nan
-        elif survey=='WISE':
-            code='vizier:II/311/wise'
-            col1=['JNAME','ra','dec','W1mag','e_W1mag','W2mag','e_W2mag','W3mag','e_W3mag','W4mag','e_W4mag','cc_flags']
-            hea=['ID','ra','dec','W1_w','W1_w_err','W2_w','W2_w_err','W3_w','W3_w_err','W4_w','W4_w_err','ccf_w']
-            fmt=(".5f",".8f",".8f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".3f",".3f")
-            f_list=['W1_w','W2_w','W3_w','W4_w']
-            q_flags=['ccf_w']
-            fill_value='ZZZZ'
-            
-        return code,col1,hea,fmt,f_list,q_flags,fill_value
-
-    def survey_radec(survey):
-        if survey=='GAIA_EDR3':
-            ra_name='ra_epoch2000'
-            dec_name='dec_epoch2000'
-        elif survey=='GAIA_DR2':
-            ra_name='ra_epoch2000'
-            dec_name='dec_epoch2000'
-        elif survey=='2MASS':
-            ra_name='RAJ2000'
-            dec_name='DEJ2000'
-        if survey=='ALLWISE':
-            ra_name='RAJ2000'
-            dec_name='DEJ2000'
-        if survey=='WISE':
-            ra_name='ra'
-            dec_name='dec'        
-        return ra_name,dec_name
-    
-    #stores path, file name, extension
+    #stores path and file name
     path=os.path.dirname(filename)     #working path
     sample_name=os.path.split(filename)[1] #file name
     i=0
     while sample_name[i]!='.': i=i+1
-    ext=sample_name[i:] #estension
     sample_name=sample_name[:i]
-    if ext=='.csv': delim=','
-    else: delim=None
 
     
     surveys0=['GAIA_EDR3','GAIA_DR2']
@@ -922,213 +2284,233 @@ def search_phot(filename,surveys,coordinates='equatorial',verbose=False,overwrit
 
     file=''+sample_name
     for i in range(len(surveys)): file+='_'+surveys[i]
-    PIK=os.path.join(path,(file+'.pkl'))
+    if type(query_cache)==type(None): query_cache=os.path.join(path,'query_cache')
     
     nf=0 #total no. of filters
     nq=0 #total no. of quality flags
     for i in range(len(surveys)): 
-        nf+=len(survey_properties(surveys[i])[4])
-        nq+=len(survey_properties(surveys[i])[5])
+        nf+=len(_survey_properties(surveys[i])[4])
+        nq+=len(_survey_properties(surveys[i])[5])
     
-    if (file_search(PIK)) & (overwrite==0) : #see if the search result is already present
-        with open(PIK,'rb') as f:
-            phot=pickle.load(f)
-            phot_err=pickle.load(f)
-            kin=pickle.load(f)
-            flags2=pickle.load(f)
-            headers=pickle.load(f)
-    else:
-        #is the input file a coordinate file or a list of star names?
-        if coordinates=='equatorial': #list of equatorial coordinates
-            coo_array = np.genfromtxt(filename,delimiter=delim)
-            n=len(coo_array)
-        elif coordinates=='galactic': #list of galactic coordinates
-            old_coo = np.genfromtxt(filename,delimiter=delim)
-            gc = SkyCoord(l=old_coo[:,0]*u.degree, b=old_coo[:,1]*u.degree, frame='galactic')
-            ec=gc.icrs
-            coo_array=np.transpose([ec.ra.deg,ec.dec.deg])
-            n=len(coo_array)
-        else: #list of star names
-            if ext!='.csv':            
-                with open(filename) as f:
-                    target_list = np.genfromtxt(f,dtype="str",delimiter='*@.,')
-            else:
-                target_list = (pd.read_csv(filename, sep=',', header=0, comment='#', usecols=['Name'])).to_numpy()
-                target_list = target_list.reshape(len(target_list))
-            n=len(target_list)
-            print(type(target_list))
-            print(target_list.shape)
-            gex=0
-            coo_array=np.zeros([n,2])
-            for i in range(n):
-                x=Simbad.query_object(target_list[i])
-                if type(x)==type(None):
-                    x=Vizier.query_object(target_list[i],catalog='I/350/gaiaedr3',radius=1*u.arcsec) #tries alternative resolver
-                    if len(x)>0:
-                        if len(x[0]['RAJ2000'])>1:
-                            if 'Gaia' in target_list[i]:
-                                c=0
-                                while str(x[0]['Source'][c]) not in target_list[i]:
-                                    c=c+1
-                                    if c==len(x[0]['RAJ2000']): break
-                                if c==len(x[0]['RAJ2000']): c=np.argmin(x[0]['Gmag'])
-                                coo_array[i,0]=x[0]['RAJ2000'][c]
-                                coo_array[i,1]=x[0]['DEJ2000'][c]
-                        else:
-                            coo_array[i,0]=x[0]['RAJ2000']
-                            coo_array[i,1]=x[0]['DEJ2000']
-                    else:
-                        coo_array[i,0]=np.nan
-                        coo_array[i,1]=np.nan                
-                        print('Star',target_list[i],' not found. Perhaps misspelling? Setting row to NaN.')
-                        gex=1
-                else:
-                    coo_array[i,0]=Angle(ang_deg(x['RA'].data.data[0])).degree
-                    coo_array[i,1]=Angle(ang_deg(x['DEC'].data.data[0],form='dms')).degree
-
-            if gex:
-                print('Some stars were not found. Would you like to end the program and check the spelling?')
-                print('If not, these stars will be treated as missing data')
-                key=str.lower(input('End program? [Y/N]'))
-                while 1:
-                    if key=='yes' or key=='y':
-                        print('Program ended.')
-                        return
-                    elif key=='no' or key=='n':
-                        break
-                    key=str.lower(input('Unvalid choice. Type Y or N.'))                
-
-        kin_list=np.array(['ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','radial_velocity','radial_velocity_error'])
-
-        headers=[]
-        phot=np.full([n,nf],np.nan)
-        phot_err=np.full([n,nf],np.nan)
-        kin=np.full([n,12],np.nan)
-        flags=np.full([n,nq],'',dtype='<U10')
-        flags2={}        
-            
-        #turns coo_array into a Table for XMatch
-        coo_table = Table(coo_array, names=('RA', 'DEC'))
-
-        #finds data on VizieR through a query on XMatch
-        p=0
-        p1=0
-        filt=[]
-        flag_h=[]
-        for i in range(len(surveys)):
-            cat_code,col2,hea,fmt,f_list,q_flags,fill_value=survey_properties(surveys[i])
-            n_f=len(f_list)
-            n_q=len(q_flags)
-            data_s = XMatch.query(cat1=coo_table,cat2=cat_code,max_distance=1.3 * u.arcsec, colRA1='RA',colDec1='DEC')
-            if i==1: #aggiunge colonna per BP-RP excess factor
-                C0=(data_s['phot_bp_mean_flux']+data_s['phot_rp_mean_flux'])/data_s['phot_g_mean_flux']
-                data_s['phot_bp_rp_excess_factor']=C0
-                data_G=np.array(np.ma.filled(data_s['phot_g_mean_mag'],fill_value=np.nan))
-                data_dG=np.array(np.ma.filled(data_s['phot_bp_mean_mag']-data_s['phot_rp_mean_mag'],fill_value=np.nan))
-                a0=lambda x: -1.121221*np.heaviside(-(x-0.5),0)-1.1244509*np.heaviside(-(x-3.5),0)-(-1.1244509*np.heaviside(-(x-0.5),0))-0.9288966*np.heaviside(x-3.5,1)
-                a1=lambda x: 0.0505276*np.heaviside(-(x-0.5),0)+0.0288725*np.heaviside(-(x-3.5),0)-(0.0288725*np.heaviside(-(x-0.5),0))-0.168552*np.heaviside(x-3.5,1)
-                a2=lambda x: -0.120531*np.heaviside(-(x-0.5),0)-0.0682774*np.heaviside(-(x-3.5),0)-(-0.0682774*np.heaviside(-(x-0.5),0))
-                a3=lambda x: 0.00795258*np.heaviside(-(x-3.5),0)-(0.00795258*np.heaviside(-(x-0.5),0))
-                a4=lambda x: -0.00555279*np.heaviside(-(x-0.5),0)-0.00555279*np.heaviside(-(x-3.5),0)-(-0.00555279*np.heaviside(-(x-0.5),0))-0.00555279*np.heaviside(x-3.5,1)
-                C1 = C0 + a0(data_dG)+a1(data_dG)*data_dG+a2(data_dG)*data_dG**2+a3(data_dG)*data_dG**3+a4(data_dG)*data_G #final corrected factor
-                data_s['phot_bp_rp_excess_factor_corrected']=C1
-            n_cat2=len(data_s)
-            cat2=np.zeros([n_cat2,2])
-            cat2[:,0]=data_s[survey_radec(surveys[i])[0]]
-            cat2[:,1]=data_s[survey_radec(surveys[i])[1]]
-            if verbose==True:
-                f=open(os.path.join(path,str(sample_name+'_'+surveys[i]+'_data.txt')), "w+")
-                f.write(tabulate(data_s[col2], 
-                                 headers=hea, tablefmt='plain', stralign='right', numalign='right', floatfmt=fmt))
-                data_s=data_s[col2]
-                data_s.rename_columns(col2,hea)        
-                f.close()                
+    #is the input file a coordinate file or a list of star names?
+    if coordinates=='equatorial': #list of equatorial coordinates
+        coo_array = read_coordinates(filename)
+        n=len(coo_array)
+    elif coordinates=='galactic': #list of galactic coordinates
+        old_coo = read_coordinates(filename)
+        gc = SkyCoord(l=old_coo[:,0]*u.degree, b=old_coo[:,1]*u.degree, frame='galactic')
+        ec=gc.icrs
+        coo_array=np.transpose([ec.ra.deg,ec.dec.deg])
+        n=len(coo_array)
+    else: #list of star names
+        target_list = read_names(filename)
+        n=len(target_list)
+        print(type(target_list))
+        print(target_list.shape)
+        if type(name_cache)==type(None): name_cache=os.path.join(path,'star_names.sqlite')
+        coo_array=resolve_names(target_list,cache=name_cache)
+        gex=0
+        for i in range(n):
+            if np.isnan(coo_array[i,0]):
+                print('Star',target_list[i],' not found. Perhaps misspelling? Setting row to NaN.')
+                gex=1
+
+        if gex:
+            miss,=np.where(np.isnan(coo_array[:,0]))
+            write_table(os.path.join(path,sample_name+'_unresolved'),Table([miss,np.array(target_list)[miss]]),['row','name'],out_format=out_format)
+        if gex and batch==False:
+            print('Some stars were not found. Would you like to end the program and check the spelling?')
+            print('If not, these stars will be treated as missing data')
+            key=str.lower(input('End program? [Y/N]'))
+            while 1:
+                if key=='yes' or key=='y':
+                    print('Program ended.')
+                    return
+                elif key=='no' or key=='n':
+                    break
+                key=str.lower(input('Unvalid choice. Type Y or N.'))                
+
+    kin_list=np.array(['ra','ra_error','dec','dec_error','parallax','parallax_error','pmra','pmra_error','pmdec','pmdec_error','radial_velocity','radial_velocity_error'])
+
+    headers=[]
+    phot=np.full([n,nf],np.nan)
+    phot_err=np.full([n,nf],np.nan)
+    kin=np.full([n,12],np.nan)
+    flags=np.full([n,nq],'',dtype='<U10')
+    flags2={}        
+        
+    #turns coo_array into a Table for XMatch
+    coo_table = Table(coo_array, names=('RA', 'DEC'))
+    keys=_coo_keys(coo_array)
+    u_keys=np.unique(keys)
+
+    #loads the stars already queried for each survey (see _survey_cache): only the missing ones are sent to XMatch
+    os.makedirs(query_cache,exist_ok=True)
+    cache_keys={}
+    cache_data={}
+    todo={}
+    for survey in surveys:
+        cache_keys[survey],cache_data[survey]=_survey_cache(query_cache,survey)
+        if overwrite==0: todo[survey]=np.where(np.isin(keys,list(cache_keys[survey]),invert=True))[0]
+        else: todo[survey]=np.arange(n)
+        todo[survey]=todo[survey][np.unique(keys[todo[survey]],return_index=True)[1]] #coordinate ripetute: una sola query
+        todo[survey].sort()
+
+    #finds data on VizieR through a query on XMatch
+    chunk_path=os.path.join(path,file+'_chunks')
+    os.makedirs(chunk_path,exist_ok=True)
+    if type(chunk_size)==type(None): chunk_size=max(n,1)
+
+    def query(task):
+        survey,start=task
+        rows=todo[survey][start:start+chunk_size]
+        chunk=coo_table[rows]
+        chunk['row_id']=np.arange(len(rows)) #riporta ogni riga del risultato alla sua stella
+        chunk_file=os.path.join(chunk_path,survey+'_'+str(chunk_size)+'_'+str(start)+'.pkl')
+        if (file_search(chunk_file)) & (overwrite==0): #chunk già scaricato in una esecuzione precedente
+            with open(chunk_file,'rb') as f:
+                coo_c=pickle.load(f)
+                data_c=pickle.load(f)
+            if np.array_equal(coo_c,coo_array[rows],equal_nan=True): return data_c
+        for attempt in range(max_retries+1):
             try:
-                para=data_s['parallax']
-            except KeyError: para=np.full(n_cat2,1000)
-            mag=data_s[f_list[0]]
-            indG1,indG2=cross_match(coo_array,cat2,max_difference=0.001,other_column=mag,rule='min',parallax=para)
-            for j in range(n_f):
-                mag_i=data_s[f_list[j]]
-                phot[indG1,j+p]=np.ma.filled(mag_i[indG2],fill_value=np.nan) #missing values replaced by NaN
-                try:
-                    mag_err=data_s[f_list[j]+'_err']
-                except KeyError:
-                    mag_eofl=data_s[f_list[j]+'_flux_err']/data_s[f_list[j]+'_flux']
-                    mag_err=0.5*(2.5*np.log10(1+mag_eofl)-2.5*np.log10(1-mag_eofl))                    
-                phot_err[indG1,j+p]=np.ma.filled(mag_err[indG2],fill_value=np.nan) #missing values replaced by NaN
-            p+=n_f
-            filt.extend(f_list)
-            if i==0:
-                for j in range(len(kin_list)):
-                    kin_i=data_s[kin_list[j]] 
-                    kin[indG1,j]=np.ma.filled(kin_i[indG2],fill_value=np.nan) #missing values replaced by NaN
-
-            flags2[surveys[i]]={}
-            for j in range(n_q):
-                flag=data_s[q_flags[j]]
-                flags[indG1,j+p1]=np.ma.filled(flag[indG2],fill_value=np.nan) #missing values replaced by NaN
-                temp_flag=np.array(np.ma.filled(flag[indG2],fill_value=np.nan))
-                dd=np.full_like(temp_flag,fill_value,shape=n)
-                dd[indG1]=temp_flag
-                flags2[surveys[i]][q_flags[j]]=dd
-            p1+=n_q
-            flag_h.extend(q_flags)
-            
-        filt2=[s+'_err' for s in filt]
-
-        filt=np.array(filt)
-        filt2=np.array(filt2)
-        flag_h=np.array(flag_h)
-
-        if merge=='WISE':
-            w_w=where_v(['W1_w','W2_w','W3_w','W4_w'],filt)
-            w_a=where_v(['W1','W2','W3','W4'],filt)
-            nw_w=complement_v(w_w,len(filt))
-            for j in range(4): 
-                phot[:,w_a[j]]=np.where(isnumber(phot_err[:,w_a[j]],finite=True), phot[:,w_a[j]], phot[:,w_w[j]])
-                phot_err[:,w_a[j]]=np.where(isnumber(phot_err[:,w_a[j]],finite=True), phot_err[:,w_a[j]], phot_err[:,w_w[j]])
-            filt=filt[nw_w]
-            filt2=filt2[nw_w]
-            cc=where_v(['ccf','ccf_w'],flag_h)
-            flags[:,cc[0]]=np.where(isnumber(phot_err[:,w_a[j]],finite=True), flags[:,cc[0]], flags[:,cc[1]])
-            flags2['WISE']['ccf']=flags[:,cc[0]]
-            phot=phot[:,nw_w] #deletes WISE magn
-            phot_err=phot_err[:,nw_w]
-            ncc=complement_v(cc[1],len(flag_h))
-            flags=flags[:,ncc]
-            flag_h=flag_h[ncc]
+                if type(catalogue_path)==type(None): data_c=XMatch.query(cat1=chunk,cat2=_survey_properties(survey)[0],max_distance=1.3 * u.arcsec, colRA1='RA',colDec1='DEC',cols2=','.join(_query_cols(survey)))
+                else: data_c=local_xmatch(chunk,survey,catalogue_path,max_distance=1.3 * u.arcsec, colRA1='RA',colDec1='DEC')
+                break
+            except Exception:
+                if attempt==max_retries: raise
+                time.sleep(retry_wait*2**attempt)
+        data_c['_key']=keys[rows][np.array(data_c['row_id'],dtype=int)]
+        data_c=data_c[[x for x in data_c.colnames if x in _query_cols(survey) or x in ['RA','DEC','_key']]]
+        with open(chunk_file+'.tmp','wb') as f:
+            pickle.dump(coo_array[rows],f)
+            pickle.dump(data_c,f)
+        os.replace(chunk_file+'.tmp',chunk_file)
+        return data_c
+
+    tasks=[(survey,start) for survey in surveys for start in range(0,len(todo[survey]),chunk_size)]
+    n_jobs=len(surveys) if type(n_jobs)==type(None) else n_jobs
+    with ThreadPoolExecutor(max_workers=max(1,n_jobs)) as executor: #il tempo è dominato dalla latenza delle query: le survey vengono interrogate insieme
+        data_c=list(executor.map(query,tasks))
+
+    data_all=[]
+    for survey in surveys:
+        new=[data_c[k] for k in range(len(tasks)) if tasks[k][0]==survey]
+        if len(new)>0: #aggiorna la cache della survey
+            done=keys[todo[survey]]
+            old=cache_data[survey]
+            if type(old)!=type(None): new.insert(0,old[np.isin(old['_key'],done,invert=True)])
+            cache_keys[survey].update(done)
+            cache_data[survey]=vstack(new,metadata_conflicts='silent') if len(new)>1 else new[0]
+            cache_data[survey]=cache_data[survey][[x for x in cache_data[survey].colnames if x in _query_cols(survey) or x in ['RA','DEC','_key']]] #cache scritte da versioni precedenti
+            _survey_cache(query_cache,survey,cache_keys[survey],cache_data[survey])
+        data_s=cache_data[survey]
+        data_all.append(data_s[np.isin(data_s['_key'],u_keys)])
+    del data_c,cache_data
+
+    p=0
+    p1=0
+    filt=[]
+    flag_h=[]
+    for i in range(len(surveys)):
+        cat_code,col2,hea,fmt,f_list,q_flags,fill_value=_survey_properties(surveys[i])
+        n_f=len(f_list)
+        n_q=len(q_flags)
+        data_s=data_all[i]
+        data_all[i]=None
+        if i==1: #aggiunge colonna per BP-RP excess factor
+            C0=(data_s['phot_bp_mean_flux']+data_s['phot_rp_mean_flux'])/data_s['phot_g_mean_flux']
+            data_s['phot_bp_rp_excess_factor']=C0
+            data_G=np.array(np.ma.filled(data_s['phot_g_mean_mag'],fill_value=np.nan))
+            data_dG=np.array(np.ma.filled(data_s['phot_bp_mean_mag']-data_s['phot_rp_mean_mag'],fill_value=np.nan))
+            a0=lambda x: -1.121221*np.heaviside(-(x-0.5),0)-1.1244509*np.heaviside(-(x-3.5),0)-(-1.1244509*np.heaviside(-(x-0.5),0))-0.9288966*np.heaviside(x-3.5,1)
+            a1=lambda x: 0.0505276*np.heaviside(-(x-0.5),0)+0.0288725*np.heaviside(-(x-3.5),0)-(0.0288725*np.heaviside(-(x-0.5),0))-0.168552*np.heaviside(x-3.5,1)
+            a2=lambda x: -0.120531*np.heaviside(-(x-0.5),0)-0.0682774*np.heaviside(-(x-3.5),0)-(-0.0682774*np.heaviside(-(x-0.5),0))
+            a3=lambda x: 0.00795258*np.heaviside(-(x-3.5),0)-(0.00795258*np.heaviside(-(x-0.5),0))
+            a4=lambda x: -0.00555279*np.heaviside(-(x-0.5),0)-0.00555279*np.heaviside(-(x-3.5),0)-(-0.00555279*np.heaviside(-(x-0.5),0))-0.00555279*np.heaviside(x-3.5,1)
+            C1 = C0 + a0(data_dG)+a1(data_dG)*data_dG+a2(data_dG)*data_dG**2+a3(data_dG)*data_dG**3+a4(data_dG)*data_G #final corrected factor
+            data_s['phot_bp_rp_excess_factor_corrected']=C1
+        n_cat2=len(data_s)
+        cat2=np.zeros([n_cat2,2])
+        cat2[:,0]=data_s[_survey_radec(surveys[i])[0]]
+        cat2[:,1]=data_s[_survey_radec(surveys[i])[1]]
+        data_s=data_s[col2]
+        data_s.rename_columns(col2,hea)        
+        if verbose==True:
+            write_table(os.path.join(path,str(sample_name+'_'+surveys[i]+'_data')),data_s,hea,out_format=out_format,floatfmt=fmt)
+        try:
+            para=data_s['parallax']
+        except KeyError: para=np.full(n_cat2,1000)
+        mag=data_s[f_list[0]]
+        indG1,indG2=cross_match(coo_array,cat2,max_difference=0.001,other_column=mag,rule='min',parallax=para,sky=True)
+        for j in range(n_f):
+            mag_i=data_s[f_list[j]]
+            phot[indG1,j+p]=np.ma.filled(mag_i[indG2],fill_value=np.nan) #missing values replaced by NaN
+            try:
+                mag_err=data_s[f_list[j]+'_err']
+            except KeyError:
+                mag_eofl=data_s[f_list[j]+'_flux_err']/data_s[f_list[j]+'_flux']
+                mag_err=0.5*(2.5*np.log10(1+mag_eofl)-2.5*np.log10(1-mag_eofl))                    
+            phot_err[indG1,j+p]=np.ma.filled(mag_err[indG2],fill_value=np.nan) #missing values replaced by NaN
+        p+=n_f
+        filt.extend(f_list)
+        if i==0:
+            for j in range(len(kin_list)):
+                kin_i=data_s[kin_list[j]] 
+                kin[indG1,j]=np.ma.filled(kin_i[indG2],fill_value=np.nan) #missing values replaced by NaN
+
+        flags2[surveys[i]]={}
+        for j in range(n_q):
+            flag=data_s[q_flags[j]]
+            flags[indG1,j+p1]=np.ma.filled(flag[indG2],fill_value=np.nan) #missing values replaced by NaN
+            temp_flag=np.array(np.ma.filled(flag[indG2],fill_value=np.nan))
+            dd=np.full_like(temp_flag,fill_value,shape=n)
+            dd[indG1]=temp_flag
+            flags2[surveys[i]][q_flags[j]]=dd
+        p1+=n_q
+        flag_h.extend(q_flags)
         
-        headers.append(filt)
-        headers.append(kin_list)
-#        headers.append(flag_h)
+    filt2=[s+'_err' for s in filt]
 
-        fff=[]
-        fff.extend(filt)
-        fff.extend(filt2)
+    filt=np.array(filt)
+    filt2=np.array(filt2)
+    flag_h=np.array(flag_h)
 
-        if verbose==True:         
-            f=open(os.path.join(path,(sample_name+'_photometry.txt')), "w+")
-            f.write(tabulate(np.concatenate((phot,phot_err),axis=1),headers=fff, tablefmt='plain', stralign='right',
-                             numalign='right', floatfmt=".4f"))
-            f.close()
+    if merge=='WISE':
+        w_w=where_v(['W1_w','W2_w','W3_w','W4_w'],filt)
+        w_a=where_v(['W1','W2','W3','W4'],filt)
+        nw_w=complement_v(w_w,len(filt))
+        for j in range(4): 
+            phot[:,w_a[j]]=np.where(isnumber(phot_err[:,w_a[j]],finite=True), phot[:,w_a[j]], phot[:,w_w[j]])
+            phot_err[:,w_a[j]]=np.where(isnumber(phot_err[:,w_a[j]],finite=True), phot_err[:,w_a[j]], phot_err[:,w_w[j]])
+        filt=filt[nw_w]
+        filt2=filt2[nw_w]
+        cc=where_v(['ccf','ccf_w'],flag_h)
+        flags[:,cc[0]]=np.where(isnumber(phot_err[:,w_a[j]],finite=True), flags[:,cc[0]], flags[:,cc[1]])
+        flags2['WISE']['ccf']=flags[:,cc[0]]
+        phot=phot[:,nw_w] #deletes WISE magn
+        phot_err=phot_err[:,nw_w]
+        ncc=complement_v(cc[1],len(flag_h))
+        flags=flags[:,ncc]
+        flag_h=flag_h[ncc]
+    
+    headers.append(filt)
+    headers.append(kin_list)
+#        headers.append(flag_h)
 
-            f=open(os.path.join(path,(sample_name+'_kinematics.txt')), "w+")
-            f.write(tabulate(kin,headers=kin_list, tablefmt='plain', stralign='right', numalign='right', 
-                             floatfmt=(".11f",".4f",".11f",".4f",".4f",".4f",".3f",".3f",".3f",".3f",".3f",".3f")))
-            f.close()
-            
-            f=open(os.path.join(path,(sample_name+'_properties.txt')), "w+")
-            f.write(tabulate(flags,headers=flag_h, tablefmt='plain', stralign='right', numalign='right'))
-            f.close()
-        
-        with open(PIK,'wb') as f:
-            pickle.dump(phot,f)
-            pickle.dump(phot_err,f)
-            pickle.dump(kin,f)
-            pickle.dump(flags2,f)
-            pickle.dump(headers,f)
+    fff=[]
+    fff.extend(filt)
+    fff.extend(filt2)
+
+    if verbose==True:         
+        write_table(os.path.join(path,(sample_name+'_photometry')),np.concatenate((phot,phot_err),axis=1),fff,
+                    out_format=out_format,floatfmt=".4f")
+        write_table(os.path.join(path,(sample_name+'_kinematics')),kin,kin_list,out_format=out_format,
+                    floatfmt=(".11f",".4f",".11f",".4f",".4f",".4f",".3f",".3f",".3f",".3f",".3f",".3f"))
+        write_table(os.path.join(path,(sample_name+'_properties')),flags,flag_h,out_format=out_format)
     
+    shutil.rmtree(chunk_path,ignore_errors=True)
+
     return phot,phot_err,kin,flags2,headers
 
 def Wu_line_integrate(f,x0,x1,y0,y1,z0,z1,layer=None):
@@ -1290,7 +2672,7 @@ def interstellar_ext(ra=None,dec=None,l=None,b=None,par=None,d=None,test_time=Fa
         else:
             return extinction(ebv,color),extinction(ebv_s,color)
 
-def cross_match(cat1,cat2,max_difference=0.01,other_column=None,rule=None,exact=False,parallax=None,min_parallax=2):
+def cross_match(cat1,cat2,max_difference=0.01,other_column=None,rule=None,exact=False,parallax=None,min_parallax=2,sky=False):
     """
     given two catalogues cat1 and cat2, returns the indices ind1 and ind2 such that:
     cat1[ind1]=cat2[ind2]
@@ -1312,6 +2694,10 @@ def cross_match(cat1,cat2,max_difference=0.01,other_column=None,rule=None,exact=
         rule (optional): mandatory if other_column is set. rule='min' to select the lowest value,
             rule='max' to select the highest value
         exact: whether to look for an exact cross-match (e.g., for IDs or proper names) or not.
+        parallax (optional): a 1D array with one entry per cat2 row. Only sources with parallax>min_parallax are cross-matched.
+        min_parallax (optional): see parallax. Default: 2
+        sky (optional): if True, cat1 and cat2 are (ra, dec) in degrees, and max_difference is the maximum angular
+            separation (deg) between two sources. Default: False (=|ra1-ra2|+|dec1-dec2|<max_difference, see usage).
 
     usage:
         if exact=False (default mode):
@@ -1320,6 +2706,8 @@ def cross_match(cat1,cat2,max_difference=0.01,other_column=None,rule=None,exact=
             cross_match(cat1,cat2,max_difference=0.03,other_column=radius,rule='min')
             tries to find, for each i, the star such that |ra1[i]-ra2|+|dec1[i]-dec2|<0.03.
             If two stars cat2[j,:] and cat2[k,:] are returned, it picks the j-th if radius[j]<radius[k], the k-th otherwise
+            cross_match(cat1,cat2,max_difference=0.001,other_column=radius,rule='min',sky=True)
+            selects instead the stars of cat2 with angular distance <0.001 deg from the i-th star of cat1.
         if exact=True:
             cross_match(cat1,cat2,exact=True)
             returns ind1, ind2 such that cat1[ind1]=cat2[ind2] (strict equality).
@@ -1329,6 +2717,8 @@ def cross_match(cat1,cat2,max_difference=0.01,other_column=None,rule=None,exact=
         The number of columns of cat2 must be the same of cat1.
         The number of elements in other_column must equal the number of rows of cat2.
         rule must be set if other_column is set.
+        Candidate pairs are found with a KD-tree (on unit vectors if sky=True), so the time scales as (n1+n2)*log(n2)
+        instead of n1*n2.
     if exact=True:
         no keyword other than cat1 and cat2 will be used.
         cat1 and cat2 must be 1D arrays.
@@ -1344,104 +2734,75 @@ def cross_match(cat1,cat2,max_difference=0.01,other_column=None,rule=None,exact=
         ind1,=np.where(cat2[c1[c]]==cat1)
         return ind1,c1[c[ind1]]
 
-    n=len(cat1)
-    ind1=np.zeros(n,dtype='int32')
-    ind2=np.zeros(n,dtype='int32')
-    c=0
+    from scipy.spatial import cKDTree
+
+    if type(cat1)==Table: 
+        cat1=np.lib.recfunctions.structured_to_unstructured(np.array(cat1))        
+    if type(cat2)==Table: 
+        cat2=np.lib.recfunctions.structured_to_unstructured(np.array(cat2))
+    cat1=np.asarray(cat1,dtype=float)
+    cat2=np.asarray(cat2,dtype=float)
+    if cat1.ndim==1:
+        cat1=cat1.reshape(-1,1)
+        cat2=cat2.reshape(-1,1)
+    elif cat1.shape[1]!=cat2.shape[1]: 
+        raise ValueError("The number of columns of cat1 must equal that of cat2.")
+    if type(other_column)!=type(None):
+        if rule not in ['min','max']: raise NameError("Keyword 'rule' not set! Specify if rule='min' or rule='max'")
+        if len(other_column)!=len(cat2): 
+            raise ValueError("The length of other_column must equal the no. of rows of cat2.")
     if type(parallax)==type(None): parallax=3.
-    if n_dim(cat1)==1:
-        if type(other_column)==type(None):
-            for i in range(n):
-                k,=np.where((abs(cat2-cat1[i])<max_difference) & (parallax>min_parallax))
-                if len(k)==1:
-                    ind1[c]=i
-                    ind2[c]=k
-                    c+=1
-                elif len(k)>1:
-                    ind1[c]=i
-                    ind2[c]=k[0]
-                    c+=1
-        elif rule=='min':
-            for i in range(n):
-                k,=np.where((abs(cat2-cat1[i])<max_difference) & (parallax>min_parallax))
-                if len(k)==1:
-                    ind1[c]=i
-                    ind2[c]=k
-                    c+=1
-                elif len(k)>1:
-                    ind1[c]=i
-                    k1=np.argmin(other_column[k])
-                    ind2[c]=k[k1]
-                    c+=1
-        elif rule=='max':
-            for i in range(n):
-                k,=np.where((abs(cat2-cat1[i])<max_difference) & (parallax>min_parallax))
-                if len(k)==1:
-                    ind1[c]=i
-                    ind2[c]=k
-                    c+=1
-                elif len(k)>1:
-                    ind1[c]=i
-                    k1=np.argmax(other_column[k])
-                    ind2[c]=k[k1]
-                    c+=1
-        else: raise NameError("Keyword 'rule' not set! Specify if rule='min' or rule='max'")                    
+    good2=np.broadcast_to(np.asarray(parallax>min_parallax),(len(cat2),))
+
+    #coppie candidate (i,k) tramite KD-tree, poi il criterio esatto
+    if sky:
+        if cat1.shape[1]!=2: raise ValueError("If sky=True, cat1 and cat2 must have two columns (ra, dec).")
+        def unit(cat):
+            ra=np.radians(cat[:,0])
+            dec=np.radians(cat[:,1])
+            return np.column_stack((np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)))
+        x1=unit(cat1)
+        x2=unit(cat2)
+        r=2*np.sin(np.radians(max_difference)/2) #corda corrispondente a max_difference
+        p=2
     else:
-        if type(cat1)==Table: 
-            cat1=np.lib.recfunctions.structured_to_unstructured(np.array(cat1))        
-        if type(cat2)==Table: 
-            cat2=np.lib.recfunctions.structured_to_unstructured(np.array(cat2))
-        
-        if len(cat1[0])!=len(cat2[0]): 
-            raise ValueError("The number of columns of cat1 must equal that of cat2.")
-        if type(other_column)==type(None):
-            for i in range(n):
-                d=0
-                for j in range(len(cat1[0])): d+=abs(cat2[:,j]-cat1[i,j])
-                k,=np.where((d<max_difference) & (parallax>min_parallax))
-                if len(k)==1:
-                    ind1[c]=i
-                    ind2[c]=k
-                    c+=1
-                elif len(k)>1:
-                    ind1[c]=i
-                    ind2[c]=k[0]
-                    c+=1
-        elif rule=='min':
-            if len(other_column)!=len(cat2): 
-                raise ValueError("The length of other_column must equal the no. of rows of cat2.")
-            for i in range(n):
-                d=0
-                for j in range(len(cat1[0])): d+=abs(cat2[:,j]-cat1[i,j])
-                k,=np.where((d<max_difference) & (parallax>min_parallax))
-                if len(k)==1:
-                    ind1[c]=i
-                    ind2[c]=k
-                    c+=1
-                elif len(k)>1:
-                    ind1[c]=i
-                    k1=np.argmin(other_column[k])
-                    ind2[c]=k[k1]
-                    c+=1
-        elif rule=='max':
-            if len(other_column)!=len(cat2): 
-                raise ValueError("The length of other_column must equal the no. of rows of cat2.")
-            for i in range(n):
-                d=0
-                for j in range(len(cat1[0])): d+=abs(cat2[:,j]-cat1[i,j])
-                k,=np.where((d<max_difference) & (parallax>min_parallax))
-                if len(k)==1:
-                    ind1[c]=i
-                    ind2[c]=k
-                    c+=1
-                elif len(k)>1:
-                    ind1[c]=i
-                    k1=np.argmax(other_column[k])
-                    ind2[c]=k[k1]
-                    c+=1
-        else: raise NameError("Keyword 'rule' not set! Specify if rule='min' or rule='max'")                
-    ind1=ind1[0:c]
-    ind2=ind2[0:c]
+        x1=cat1
+        x2=cat2
+        r=max_difference
+        p=1
+    v1,=np.where(np.all(np.isfinite(x1),axis=1))
+    v2,=np.where(np.all(np.isfinite(x2),axis=1) & good2)
+    if len(v1)>0 and len(v2)>0:
+        t1=cKDTree(x1[v1])
+        t2=cKDTree(x2[v2])
+        pairs=t1.sparse_distance_matrix(t2,r*(1+1e-9),p=p,output_type='ndarray') #raggio appena più ampio: il taglio esatto è sotto
+        i=v1[pairs['i']]
+        k=v2[pairs['j']]
+    else:
+        i=np.zeros(0,dtype=int)
+        k=np.zeros(0,dtype=int)
+    if sky: d=np.sum((x2[k]-x1[i])**2,axis=1)<r**2
+    else:
+        d=0
+        for j in range(cat1.shape[1]): d+=abs(cat2[k,j]-cat1[i,j])
+        d=d<max_difference
+    i=i[d]
+    k=k[d]
+
+    #per ogni stella di cat1, la prima di cat2 o quella con other_column minimo/massimo
+    if type(other_column)==type(None): w=np.lexsort((k,i))
+    else:
+        oc=np.ma.asarray(other_column)
+        v=np.array(oc.data,dtype=float)[k]
+        if rule=='max': v=-v
+        v[np.isnan(v)]=-np.inf #come np.argmin/np.argmax, un NaN viene scelto per primo
+        v[np.ma.getmaskarray(oc)[k]]=np.inf #come MaskedArray.argmin/argmax, i valori mascherati per ultimi
+        w=np.lexsort((k,v,i))
+    i=i[w]
+    k=k[w]
+    first=np.unique(i,return_index=True)[1]
+    ind1=i[first].astype('int32')
+    ind2=k[first].astype('int32')
     return ind1,ind2
 
 def file_search(files):
@@ -1474,6 +2835,47 @@ def file_search(files):
                 return 0
     return 1
 
+_table_ext={'csv':'.csv','fits':'.fits','hdf5':'.h5','parquet':'.parquet','txt':'.txt'}
+
+def write_table(filename,data,headers,out_format='csv',floatfmt='g'):
+    """
+    writes a table to a file, in one of the following formats:
+        'csv': comma-separated values, written through pandas, with full precision;
+        'fits': FITS binary table;
+        'hdf5': HDF5 table (path 'data');
+        'parquet': Apache Parquet (requires pyarrow);
+        'txt': fixed-width text table formatted by tabulate, as the files written by previous versions.
+
+    input:
+        filename: full path of the output file, without extension (added according to out_format)
+        data: a 2D numpy array (one column per header) or an astropy Table
+        headers: list of column names
+        out_format (optional): one of the formats above. Default: 'csv'
+        floatfmt (optional): format of float numbers, only used if out_format='txt'. Default: 'g'
+
+    usage:
+        f=write_table('/path/sample_ages_mist',np.column_stack((m,a)),['MASS','AGE'],out_format='fits')
+        returns the full path of the written file ('/path/sample_ages_mist.fits').
+    """
+    if out_format not in _table_ext: raise ValueError("Keyword 'out_format' must be one of: "+', '.join(_table_ext))
+    file=str(filename)+_table_ext[out_format]
+    if out_format=='txt':
+        f=open(file, "w+")
+        f.write(tabulate(data,headers=headers, tablefmt='plain', stralign='right', numalign='right', floatfmt=floatfmt))
+        f.close()
+        return file
+    if isinstance(data,Table):
+        t=Table(data,copy=False)
+        t.rename_columns(t.colnames,list(headers))
+    else:
+        data=np.asarray(data)
+        t=Table([data[:,k] for k in range(data.shape[1])],names=list(headers),copy=False)
+    if out_format=='csv': t.to_pandas().to_csv(file,index=False)
+    elif out_format=='fits': t.write(file,format='fits',overwrite=True)
+    elif out_format=='hdf5': t.write(file,format='hdf5',path='data',serialize_meta=True,overwrite=True) #con le maschere delle colonne
+    elif out_format=='parquet': t.write(file,format='parquet',overwrite=True)
+    return file
+
 def plot_CMD(x,y,iso,x_axis,y_axis,plot_ages=[1,3,5,10,20,30,100],ebv=None,tofile=False,x_error=None,y_error=None,groups=None,group_names=None,label_points=False,**kwargs):
 
     """
@@ -1657,40 +3059,9 @@ def isochronal_age2(phot_app,phot_err_app,phot_filters,par,par_err,flags,iso,sur
 
     wc=np.array([[2,0,1,5],[3,3,3,4]]) #(G-K), (G-J), (G-H), (Gbp-Grp)
 
-    if 'G2' in fnew:
-        qfl=flags['GAIA_DR2']['dr2_bp_rp_excess_factor_corr']
-        s1=0.004+8e-12*phot[:,3]**7.55
-        q1,=np.where(abs(qfl)>3*s1)
-    else:
-        qfl=flags['GAIA_EDR3']['edr3_bp_rp_excess_factor_corr']
-        s1=0.0059898+8.817481e-12*phot[:,3]**7.618399
-        q1,=np.where(abs(qfl)>3*s1) #excluded
-    if len(q1)>0:       
-        phot[q1,4]=np.nan
-        phot_err[q1,4]=np.nan
-        phot[q1,5]=np.nan
-        phot_err[q1,5]=np.nan
-
-    qfl=flags['2MASS']['qfl']
-    qJ=[]
-    qH=[]
-    qK=[]
-    for i in range(len(qfl)):
-        if qfl[i][0]!='A': qJ.append(i)
-        if qfl[i][1]!='A': qH.append(i)
-        if qfl[i][2]!='A': qK.append(i)
-    if len(qJ)>0:
-        qJ=np.array(qJ)
-        phot[qJ,0]=np.nan
-        phot_err[qJ,0]=np.nan
-    if len(qH)>0:
-        qH=np.array(qH)
-        phot[qH,1]=np.nan
-        phot_err[qH,1]=np.nan
-    if len(qK)>0:
-        qK=np.array(qK)
-        phot[qK,2]=np.nan
-        phot_err[qK,2]=np.nan
+    bad=phot_quality_mask(phot_app,phot_filters,flags,par=par)[:,filt2]==False #tagli sulla qualità fotometrica
+    phot[bad]=np.nan
+    phot_err[bad]=np.nan
 
     red=np.zeros([xlen,ylen]) #reddening da applicare
     if type(ebv)!=type(None):